@@ -0,0 +1,286 @@
+"""Synthetic load against a running master.
+
+Publishes node-shaped claxon/* payloads and traci/step ticks to the broker,
+and connects simulated WebSocket clients with random viewports. Run with
+python -m bench.load --help.
+"""
+import argparse, asyncio, json, logging, os, threading, time, urllib.request
+import paho.mqtt.client as mqtt
+import websockets
+from bench.payloads import SyntheticZone
+from master.session.codec import BINARY_HEADER, BINARY_STRING_LENGTH, BINARY_COUNT, BINARY_VEHICLE, BINARY_FLAG_RESET, BINARY_KIND_VEHICLE
+
+logger = logging.getLogger(__name__)
+
+VEHICLE_TYPES = ("vehicle", "vehicle/delta")
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+class Publisher:
+    """Plays the nodes: topology once, then every zone's state and a traci/step at each tick."""
+
+    def __init__(self, host, port, zones, hz):
+        self.zones = zones
+        self.interval = 1.0 / hz
+        self.client = mqtt.Client(client_id=f"bench-load-{os.getpid()}")
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+        self.messages = 0
+        self.bytes = 0
+        self.steps = {}
+        self.stopping = threading.Event()
+
+    def publish(self, topic, payload):
+        self.client.publish(topic, payload, qos=1)
+        self.messages += 1
+        self.bytes += len(payload)
+
+    def step_time(self, step):
+        """When the traci/step of a step was published, None if it was not."""
+        return self.steps.get(step)
+
+    def run(self):
+        for zone in self.zones:
+            self.publish("claxon/lane/position", zone.lane_positions())
+            self.publish("claxon/traffic_light/position", zone.light_positions())
+        deadline = time.monotonic()
+        while not self.stopping.is_set():
+            for zone in self.zones:
+                zone.advance()
+                self.publish("claxon/vehicle/position", zone.vehicle_positions())
+                self.publish("claxon/lane/state", zone.lane_states())
+                self.publish("claxon/traffic_light/state", zone.light_states())
+                self.publish("claxon/accident/position", zone.accidents())
+            self.publish("traci/step", "{}")
+            self.steps[self.zones[0].step] = time.monotonic()
+            deadline += self.interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self.stopping.wait(delay)
+            else:
+                deadline = time.monotonic()
+
+    def stop(self):
+        self.stopping.set()
+        self.client.loop_stop()
+        self.client.disconnect()
+
+class SimulatedClient:
+    """One WebSocket session on a random viewport, measuring step-to-vehicle latency.
+
+    The publisher keeps a marker vehicle at the center of the viewport whose
+    speed is the step number, so each vehicle frame is matched to the step it
+    was built from.
+    """
+
+    def __init__(self, url, viewport, marker, publisher, binary=False):
+        self.url = url
+        self.viewport = viewport
+        self.marker = marker
+        self.publisher = publisher
+        self.binary = binary
+        self.strings = []
+        self.bytes = {}
+        self.latencies = []
+        self.unmatched = 0
+        self.errors = 0
+
+    def frame_step(self, message):
+        """Step number carried by the marker of a JSON vehicle frame, None when it is missing."""
+        data = json.loads(message)["data"]
+        if isinstance(data, dict):
+            # vehicle/delta: the marker's speed changes every step, so it is always in a frame
+            data = data.get("vehicles", []) + data.get("added", []) + data.get("changed", [])
+        for vehicle in data:
+            if vehicle.get("id") == self.marker and vehicle.get("speed") is not None:
+                return int(vehicle["speed"])
+        return None
+
+    def read_strings(self, message):
+        """Applies the string section of any binary frame to the table, returns (kind, records offset)."""
+        kind, version, flags, seq, count = BINARY_HEADER.unpack_from(message, 0)
+        if flags & BINARY_FLAG_RESET:
+            self.strings = []
+        offset = BINARY_HEADER.size
+        for _ in range(count):
+            (length,) = BINARY_STRING_LENGTH.unpack_from(message, offset)
+            offset += BINARY_STRING_LENGTH.size
+            self.strings.append(message[offset:offset + length].decode("utf-8"))
+            offset += length
+        return kind, offset
+
+    def binary_frame_step(self, message, offset):
+        """Step number carried by the marker of a binary vehicle frame, its records starting at offset."""
+        (records,) = BINARY_COUNT.unpack_from(message, offset)
+        offset += BINARY_COUNT.size
+        for _ in range(records):
+            vehicle_id, _, _, _, _, speed, _ = BINARY_VEHICLE.unpack_from(message, offset)
+            offset += BINARY_VEHICLE.size
+            if vehicle_id < len(self.strings) and self.strings[vehicle_id] == self.marker:
+                return int(speed)
+        return None
+
+    async def run(self, stopping):
+        try:
+            async with websockets.connect(self.url, max_size=None) as websocket:
+                await websocket.send(json.dumps({"type": "session/frame_update", "data": self.viewport}))
+                if self.binary:
+                    await websocket.send(json.dumps({"type": "session/options", "data": {"encoding": "binary"}}))
+                await websocket.send(json.dumps({"type": "session/focus", "data": {"focused": True}}))
+                while not stopping.is_set():
+                    try:
+                        message = await asyncio.wait_for(websocket.recv(), timeout=0.5)
+                    except asyncio.TimeoutError:
+                        continue
+                    received = time.monotonic()
+                    if isinstance(message, bytes):
+                        # Every binary frame may add strings or reset the table, whatever its kind
+                        kind, offset = self.read_strings(message)
+                        message_type = "vehicle" if kind == BINARY_KIND_VEHICLE else "binary"
+                    else:
+                        # The type is the first key of every frame, no need to decode the rest
+                        message_type = message[10:message.index('"', 10)] if message.startswith('{"type": "') else "unknown"
+                    self.bytes[message_type] = self.bytes.get(message_type, 0) + len(message)
+                    if message_type not in VEHICLE_TYPES:
+                        continue
+                    step = self.binary_frame_step(message, offset) if isinstance(message, bytes) else self.frame_step(message)
+                    published = self.publisher.step_time(step) if step is not None else None
+                    if published is None:
+                        self.unmatched += 1
+                    else:
+                        self.latencies.append(received - published)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Client failed: {e}")
+
+def scrape(url):
+    """Sums the samples of each metric family of a /metrics page, None when unreachable."""
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            text = response.read().decode("utf-8")
+    except OSError:
+        return None
+    totals = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        name = name.split("{")[0]
+        totals[name] = totals.get(name, 0.0) + float(value)
+    return totals
+
+class ProcessSampler:
+    """CPU time and resident memory of a process, read from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peakRss = 0
+        self.start = self.cpu_seconds()
+        self.startedAt = time.monotonic()
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def sample(self):
+        with open(f"/proc/{self.pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    self.peakRss = max(self.peakRss, int(line.split()[1]) * 1024)
+
+    def cpu_share(self):
+        return (self.cpu_seconds() - self.start) / (time.monotonic() - self.startedAt)
+
+async def run(args):
+    zones = [SyntheticZone(zone, args.lanes, args.vehicles, args.lights) for zone in range(1, args.zones + 1)]
+    before = scrape(args.metrics_url)
+    sampler = ProcessSampler(args.master_pid) if args.master_pid else None
+
+    publisher = Publisher(args.host, args.port, zones, args.hz)
+    clients = []
+    for index in range(args.clients):
+        zone = zones[index % len(zones)]
+        viewport = zone.viewport(args.viewport)
+        marker = f"bench_marker_{index}"
+        zone.add_marker(marker, viewport)
+        clients.append(SimulatedClient(args.ws_url, viewport, marker, publisher, args.binary))
+
+    publishing = threading.Thread(target=publisher.run, name="bench-publisher", daemon=True)
+    started = time.monotonic()
+    publishing.start()
+
+    stopping = asyncio.Event()
+    tasks = [asyncio.create_task(client.run(stopping)) for client in clients]
+    while time.monotonic() - started < args.duration:
+        if sampler is not None:
+            sampler.sample()
+        await asyncio.sleep(1)
+    stopping.set()
+    await asyncio.gather(*tasks)
+    publisher.stop()
+    elapsed = time.monotonic() - started
+    after = scrape(args.metrics_url)
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    sent = {}
+    for client in clients:
+        for message_type, size in client.bytes.items():
+            sent[message_type] = sent.get(message_type, 0) + size
+    report = {
+        "zones": args.zones, "vehicles": args.vehicles, "lanes": args.lanes, "hz": args.hz, "clients": args.clients,
+        "duration": elapsed,
+        "published_messages_per_second": publisher.messages / elapsed,
+        "published_bytes_per_second": publisher.bytes / elapsed,
+        "steps": len(publisher.steps),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies) if latencies else None,
+        "bytes_per_client": {message_type: size / max(1, len(clients)) for message_type, size in sent.items()},
+        "unmatched_vehicle_frames": sum(client.unmatched for client in clients),
+        "client_errors": sum(client.errors for client in clients),
+    }
+    if before is not None and after is not None:
+        handled = after.get("claxon_handler_seconds_count", 0) - before.get("claxon_handler_seconds_count", 0)
+        dropped = after.get("claxon_ingest_dropped_total", 0) - before.get("claxon_ingest_dropped_total", 0)
+        report["handled_messages_per_second"] = handled / elapsed
+        report["dropped_messages"] = dropped
+    if sampler is not None:
+        report["master_cpu"] = sampler.cpu_share()
+        report["master_peak_rss"] = sampler.peakRss
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic load generator for the master.")
+    parser.add_argument("--host", default=os.environ.get("BROKER_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("BROKER_PORT", 1883)))
+    parser.add_argument("--ws-url", default="ws://localhost:7900")
+    parser.add_argument("--metrics-url", default="http://localhost:7901/metrics")
+    parser.add_argument("--master-pid", type=int, help="pid of the master, to report its CPU and memory")
+    parser.add_argument("--zones", type=int, default=9)
+    parser.add_argument("--vehicles", type=int, default=500, help="vehicles per zone")
+    parser.add_argument("--lanes", type=int, default=2000, help="lanes per zone")
+    parser.add_argument("--lights", type=int, default=100, help="traffic lights per zone")
+    parser.add_argument("--hz", type=float, default=1.0, help="simulation steps per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--viewport", type=float, default=0.005, help="client frame size in degrees")
+    parser.add_argument("--binary", action="store_true", help="clients ask for binary vehicle frames")
+    parser.add_argument("--output", help="writes the report as JSON, to compare with a baseline")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    report = asyncio.run(run(args))
+    for key, value in report.items():
+        print(f"{key:32} {value}")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == "__main__":
+    main()
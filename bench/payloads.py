@@ -0,0 +1,129 @@
+import json, math, random
+
+# Center of the synthetic city, in degrees, zones are laid out side by side from here
+ORIGIN = (2.30, 48.85)
+# Width and height of one zone, in degrees
+ZONE_SPAN = 0.02
+
+def envelope(data, zone):
+    """Wraps a TraCI payload the way node.py forwards it to the global broker."""
+    return json.dumps({"data": data, "zone": str(zone)})
+
+class SyntheticZone:
+    """Lanes, traffic lights and vehicles of one zone, moved a little at each step.
+
+    Positions follow the TraCI order sent by nodes, [y, x].
+    """
+
+    def __init__(self, zone, lanes, vehicles, lights, seed=None):
+        self.zone = zone
+        self.random = random.Random(seed if seed is not None else zone)
+        self.minX = ORIGIN[0] + zone * ZONE_SPAN
+        self.minY = ORIGIN[1]
+        self.step = 0
+        self.lanes = [self.make_lane(index) for index in range(lanes)]
+        self.lights = [self.make_light(index) for index in range(lights)]
+        self.vehicles = [self.make_vehicle(index) for index in range(vehicles)]
+        self.jams = {lane["id"]: 0 for lane in self.lanes}
+        self.markers = []
+
+    def point(self):
+        return [self.minY + self.random.random() * ZONE_SPAN, self.minX + self.random.random() * ZONE_SPAN]
+
+    def make_lane(self, index):
+        start = self.point()
+        angle = self.random.random() * 2 * math.pi
+        shape = [start]
+        for _ in range(self.random.randint(1, 6)):
+            length = self.random.uniform(0.0001, 0.001)
+            previous = shape[-1]
+            shape.append([previous[0] + math.sin(angle) * length, previous[1] + math.cos(angle) * length])
+            angle += self.random.uniform(-0.5, 0.5)
+        return {"id": f"z{self.zone}_lane{index}", "shape": shape, "priority": self.random.randint(0, 10), "type": "road"}
+
+    def make_light(self, index):
+        lane = self.random.choice(self.lanes) if self.lanes else None
+        return {
+            "id": f"z{self.zone}_light{index}",
+            "position": lane["shape"][-1] if lane else self.point(),
+            "in_lane": lane["id"] if lane else None,
+            "out_lane": None,
+            "via_lane": None,
+            "state": "G",
+        }
+
+    def make_vehicle(self, index):
+        return {
+            "id": f"z{self.zone}_veh{index}",
+            "position": self.point(),
+            "type": self.random.choice(("car", "bus", "truck", "motorcycle")),
+            "angle": self.random.uniform(0, 360),
+            "speed": self.random.uniform(0, 15),
+            "accident": False,
+        }
+
+    def advance(self, moving=0.8):
+        """Moves a share of the vehicles, as in a simulation step."""
+        self.step += 1
+        for vehicle in self.vehicles:
+            if self.random.random() >= moving:
+                continue
+            heading = math.radians(vehicle["angle"])
+            distance = vehicle["speed"] * 1e-6
+            vehicle["position"] = [
+                vehicle["position"][0] + math.cos(heading) * distance,
+                vehicle["position"][1] + math.sin(heading) * distance,
+            ]
+            vehicle["speed"] = max(0.0, vehicle["speed"] + self.random.uniform(-1, 1))
+
+    def lane_positions(self):
+        return envelope(self.lanes, self.zone)
+
+    def lane_states(self, changing=0.05):
+        for lane_id in self.jams:
+            if self.random.random() < changing:
+                self.jams[lane_id] = round(self.random.random(), 2)
+        return envelope([{"id": lane_id, "traffic_jam": jam} for lane_id, jam in self.jams.items()], self.zone)
+
+    def light_positions(self):
+        return envelope(self.lights, self.zone)
+
+    def light_states(self, changing=0.1):
+        for light in self.lights:
+            if self.random.random() < changing:
+                light["state"] = self.random.choice("GyrR")
+        return envelope([{"id": light["id"], "state": light["state"]} for light in self.lights], self.zone)
+
+    def add_marker(self, vehicle_id, viewport):
+        """Adds a still vehicle at the center of a viewport whose speed is the current step.
+
+        Clients read it back from their vehicle frames to know which step a frame comes from.
+        """
+        self.markers.append({
+            "id": vehicle_id,
+            "position": [(viewport["minY"] + viewport["maxY"]) / 2, (viewport["minX"] + viewport["maxX"]) / 2],
+            "type": "marker",
+            "angle": 0.0,
+            "accident": False,
+        })
+
+    def vehicle_positions(self):
+        markers = [dict(marker, speed=float(self.step)) for marker in self.markers]
+        return envelope(self.vehicles + markers, self.zone)
+
+    def accidents(self):
+        crashed = [vehicle for vehicle in self.vehicles[:2] if self.step % 100 < 50]
+        return envelope({
+            "data": [
+                {"id": vehicle["id"], "position": vehicle["position"], "type": vehicle["type"], "start_time": self.step, "duration": 50}
+                for vehicle in crashed
+            ],
+            "zone": str(self.zone),
+            "current_step": self.step,
+        }, self.zone)
+
+    def viewport(self, size=0.005):
+        """Random frame inside the zone, as a session/frame_update payload."""
+        minX = self.minX + self.random.random() * (ZONE_SPAN - size)
+        minY = self.minY + self.random.random() * (ZONE_SPAN - size)
+        return {"minX": minX, "minY": minY, "maxX": minX + size, "maxY": minY + size}
@@ -0,0 +1,45 @@
+"""Records the broker's traci/# and claxon/# traffic. Run with python -m bench.record <file>."""
+import argparse, logging, os, time
+import paho.mqtt.client as mqtt
+from bench.recording import RecordingWriter
+
+logger = logging.getLogger(__name__)
+
+TOPICS = ("traci/#", "claxon/#")
+
+def main():
+    parser = argparse.ArgumentParser(description="Records MQTT traffic to a replayable file.")
+    parser.add_argument("path")
+    parser.add_argument("--host", default=os.environ.get("BROKER_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("BROKER_PORT", 1883)))
+    parser.add_argument("--duration", type=float, help="seconds, records until interrupted by default")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    writer = RecordingWriter(args.path)
+    client = mqtt.Client(client_id=f"bench-record-{os.getpid()}")
+
+    def on_connect(client, userdata, flags, rc):
+        logger.info(f"Connected to MQTT broker with result code {rc}")
+        for topic in TOPICS:
+            client.subscribe(topic, qos=1)
+
+    client.on_connect = on_connect
+    client.on_message = lambda client, userdata, msg: writer.write(msg.topic, msg.payload)
+    client.connect(args.host, args.port, 60)
+    client.loop_start()
+    started = time.monotonic()
+    try:
+        while args.duration is None or time.monotonic() - started < args.duration:
+            time.sleep(1)
+            writer.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        writer.close()
+        logger.info(f"Recorded {writer.messages} messages to {args.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Append-only file of timestamped MQTT messages, with a sidecar index of the steps.
+
+Data file: MAGIC, then one record per message, a RECORD header (Unix time of
+the message, topic length, payload length) followed by the topic and the
+payload; absolute times keep a recording monotonic across appends. Index file
+(<path>.idx): one STEP entry per traci/step message, its record offset and
+timestamp, so a replay can seek to a step without scanning. A missing, stale or
+inconsistent index is rebuilt from the data file.
+"""
+import mmap, os, struct, threading, time
+
+MAGIC = b"CLXREC1\n"
+RECORD = struct.Struct("<dHI")
+STEP = struct.Struct("<Qd")
+STEP_TOPIC = "traci/step"
+
+class RecordingWriter:
+    def __init__(self, path):
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.data = open(path, "ab")
+        if not exists:
+            self.data.write(MAGIC)
+        # A new data file makes any index left by an older recording meaningless
+        self.index = open(path + ".idx", "ab" if exists else "wb")
+        self.lock = threading.Lock()
+        self.messages = 0
+
+    def write(self, topic, payload):
+        """Appends a message, called from the MQTT thread."""
+        topic = topic.encode("utf-8")
+        timestamp = time.time()
+        with self.lock:
+            offset = self.data.tell()
+            self.data.write(RECORD.pack(timestamp, len(topic), len(payload)) + topic + payload)
+            if topic == STEP_TOPIC.encode("utf-8"):
+                self.index.write(STEP.pack(offset, timestamp))
+            self.messages += 1
+
+    def flush(self):
+        with self.lock:
+            self.data.flush()
+            self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+class Recording:
+    """Read-only view of a recording through a memory map."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a recording")
+        self.steps = self.read_index(path + ".idx")
+
+    def read_index(self, path):
+        steps = []
+        if os.path.exists(path):
+            with open(path, "rb") as index:
+                content = index.read()
+            usable = len(content) - len(content) % STEP.size
+            steps = [STEP.unpack_from(content, position) for position in range(0, usable, STEP.size)]
+            if not self.valid_steps(steps):
+                steps = []
+        # Steps recorded after the last index flush, or no index at all
+        start = steps[-1][0] if steps else len(MAGIC)
+        for offset, timestamp, topic, _ in self.records(start):
+            if topic == STEP_TOPIC and (not steps or offset > steps[-1][0]):
+                steps.append((offset, timestamp))
+        return steps
+
+    def valid_steps(self, steps):
+        """Whether every index entry points, in order, at a traci/step record of the data file."""
+        previous = len(MAGIC) - 1
+        for offset, timestamp in steps:
+            if offset <= previous or offset + RECORD.size > len(self.map):
+                return False
+            recorded, topicLength, payloadLength = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            if recorded != timestamp or start + topicLength + payloadLength > len(self.map):
+                return False
+            if self.map[start:start + topicLength] != STEP_TOPIC.encode("utf-8"):
+                return False
+            previous = offset
+        return True
+
+    def records(self, offset=None):
+        """Yields (offset, timestamp, topic, payload) from offset, stops at a truncated record."""
+        position = len(MAGIC) if offset is None else offset
+        end = len(self.map)
+        while position + RECORD.size <= end:
+            timestamp, topicLength, payloadLength = RECORD.unpack_from(self.map, position)
+            start = position + RECORD.size
+            if start + topicLength + payloadLength > end:
+                return
+            topic = self.map[start:start + topicLength].decode("utf-8")
+            payload = self.map[start + topicLength:start + topicLength + payloadLength]
+            yield position, timestamp, topic, payload
+            position = start + topicLength + payloadLength
+
+    def step_offset(self, step):
+        """Offset of the first message of a step: right after the previous traci/step."""
+        if step <= 0 or not self.steps:
+            return len(MAGIC)
+        offset = self.steps[min(step, len(self.steps)) - 1][0]
+        timestamp, topicLength, payloadLength = RECORD.unpack_from(self.map, offset)
+        return offset + RECORD.size + topicLength + payloadLength
+
+    def close(self):
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,59 @@
+"""Replays a recording to the broker. Run with python -m bench.replay <file>."""
+import argparse, logging, os, time
+import paho.mqtt.client as mqtt
+from bench.recording import Recording, STEP_TOPIC
+
+logger = logging.getLogger(__name__)
+
+def replay(recording, client, speed=1.0, step=0, steps=None):
+    """Publishes the messages from a step, at speed times the recorded pace, 0 for as fast as possible.
+
+    Returns the number of messages published.
+    """
+    published = 0
+    replayedSteps = 0
+    first = None
+    started = time.monotonic()
+    for offset, timestamp, topic, payload in recording.records(recording.step_offset(step)):
+        if first is None:
+            first = timestamp
+        if speed > 0:
+            delay = (timestamp - first) / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        client.publish(topic, bytes(payload), qos=1)
+        published += 1
+        if topic == STEP_TOPIC:
+            replayedSteps += 1
+            if steps is not None and replayedSteps >= steps:
+                break
+    return published
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a recording to an MQTT broker.")
+    parser.add_argument("path")
+    parser.add_argument("--host", default=os.environ.get("BROKER_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("BROKER_PORT", 1883)))
+    parser.add_argument("--speed", type=float, default=1.0, help="multiple of the recorded pace, 0 for max speed")
+    parser.add_argument("--step", type=int, default=0, help="starts with the messages of this step")
+    parser.add_argument("--steps", type=int, help="number of steps to replay, all by default")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    recording = Recording(args.path)
+    logger.info(f"{args.path}: {len(recording.steps)} steps")
+    client = mqtt.Client(client_id=f"bench-replay-{os.getpid()}")
+    client.connect(args.host, args.port, 60)
+    client.loop_start()
+    started = time.monotonic()
+    try:
+        published = replay(recording, client, args.speed, args.step, args.steps)
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        recording.close()
+    elapsed = time.monotonic() - started
+    logger.info(f"Replayed {published} messages in {elapsed:.1f} s ({published / max(elapsed, 1e-9):.0f} messages/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from master.database import connect_to_database
+from master.zone import normalize_zone
+import heapq, threading
+
+def getAccidents():
+    accidentsFormatted = []
+    db = connect_to_database()
+    with db.cursor() as cursor:
+        cursor.execute("""
+            SELECT vehicle_id as id,
+                   ST_X(geom) as longitude,
+                   ST_Y(geom) as latitude,
+                   type,
+                   start_time, zone, duration
+            FROM accidents
+        """)
+        accidents = cursor.fetchall()
+        for accident in accidents:
+            accidentsFormatted.append({
+                "id": accident[0],
+                "position": [accident[2], accident[1]],  # [latitude, longitude]
+                "type": accident[3],
+                "start_time": accident[4],
+                "zone": accident[5],
+                "duration": accident[6]
+            })
+    return accidentsFormatted
+
+def accident_end(accident):
+    return (accident.get("start_time") or 0) + (accident.get("duration") or 0)
+
+class AccidentStore:
+    """Accidents of every zone in memory, with an expiry heap per zone on start_time + duration.
+
+    Records have the output format of getAccidents. version changes whenever
+    the set of accidents does, so sessions can skip resending an unchanged set.
+    """
+    zones = {}
+    expiries = {}
+    version = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.expiries = {}
+        self.version = 0
+        for accident in getAccidents():
+            zone = normalize_zone(accident["zone"])
+            accident["zone"] = zone
+            self.zones.setdefault(zone, {})[accident["id"]] = accident
+            self._schedule(zone, accident)
+
+    def _schedule(self, zone, accident):
+        heapq.heappush(self.expiries.setdefault(zone, []), (accident_end(accident), accident["id"]))
+
+    def setZone(self, zone, accidents, current_step=None):
+        """Replaces the accidents of a zone with the ones a node sent, then expires the ended ones.
+
+        Returns the records added or changed, and the ids removed.
+        """
+        zone = normalize_zone(zone)
+        changed = []
+        with self.lock:
+            previous = self.zones.get(zone, {})
+            current = {}
+            for accident in accidents:
+                record = {
+                    "id": accident['id'],
+                    "position": accident['position'],
+                    "type": accident.get('type'),
+                    "start_time": accident.get('start_time', 0),
+                    "zone": zone,
+                    "duration": accident.get('duration', 10)
+                }
+                known = previous.get(record["id"])
+                if known != record:
+                    changed.append(record)
+                    self._schedule(zone, record)
+                else:
+                    record = known
+                current[record["id"]] = record
+            removed = [accident_id for accident_id in previous if accident_id not in current]
+            self.zones[zone] = current
+            if current_step is not None:
+                expired = self._expire(zone, current_step)
+                changed = [record for record in changed if record["id"] not in expired]
+                removed.extend(accident_id for accident_id in expired if accident_id in previous)
+            if changed or removed:
+                self.version += 1
+        return changed, removed
+
+    def _expire(self, zone, current_step):
+        """Drops the zone's accidents that ended at current_step, returns their ids."""
+        heap = self.expiries.get(zone, [])
+        accidents = self.zones.get(zone, {})
+        expired = set()
+        while heap and heap[0][0] <= current_step:
+            end, accident_id = heapq.heappop(heap)
+            accident = accidents.get(accident_id)
+            # Entries of records replaced since they were scheduled are stale
+            if accident is not None and accident_end(accident) == end:
+                del accidents[accident_id]
+                expired.add(accident_id)
+        return expired
+
+    def getAccidents(self):
+        """Same output as getAccidents, read from memory."""
+        with self.lock:
+            return [accident for accidents in self.zones.values() for accident in accidents.values()]
+
+def getAccidentsIn(accidents, minX, minY, maxX, maxY):
+    """Filters accidents to a frame, accident positions are [y, x]."""
+    xmin, xmax = min(minX, maxX), max(minX, maxX)
+    ymin, ymax = min(minY, maxY), max(minY, maxY)
+    return [
+        accident for accident in accidents
+        if xmin <= accident["position"][1] <= xmax and ymin <= accident["position"][0] <= ymax
+    ]
@@ -1,5 +1,8 @@
-import logging, os
+import logging, os, threading
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from master.metrics import metrics, statement_label
 
 logger = logging.getLogger(__name__)
 
@@ -11,62 +14,83 @@ DB_CONFIG = {
     "async_": False
 }
 
-db = None
+# Upper bound of simultaneous connections, one per thread using the database
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor observing the duration of each statement, labelled by verb and table."""
+
+    def execute(self, query, vars=None):
+        with metrics.timer("claxon_db_query_seconds", statement=statement_label(query)):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with metrics.timer("claxon_db_query_seconds", statement=statement_label(query)):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with metrics.timer("claxon_db_query_seconds", statement=statement_label(sql)):
+            return super().copy_expert(sql, file, size)
+
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    global pool
+    if pool is None:
+        with pool_lock:
+            if pool is None:
+                logger.debug("Creating database pool with config: %s", DB_CONFIG)
+                logger.info("Connecting to database...")
+                try:
+                    pool = psycopg2.pool.ThreadedConnectionPool(1, DB_POOL_MAX, cursor_factory=TimedCursor, **DB_CONFIG)
+                except Exception as e:
+                    logger.error(f"Database connection failed: {e}")
+                    raise
+                logger.info("Database connection established successfully.")
+    return pool
 
 def connect_to_database():
-    global db
-    """Connexion à la base de données."""
-    
-    # Check if connection is closed or None and reconnect if needed
-    if db is None or db.closed:
-        logger.debug("Attempting to connect to the database with config: %s", DB_CONFIG)
-        try:
-            logger.info("Connecting to database...")
-            db = psycopg2.connect(**DB_CONFIG)
-            db.autocommit = True
-            logger.info("Database connection established successfully.")
-        except Exception as e:
-            logger.error(f"Database connection failed: {e}")
-    else:
-        logger.debug("Using existing database connection.")
-        
-    # Test the connection to ensure it's still active
-    try:
-        with db.cursor() as test_cursor:
-            test_cursor.execute("SELECT 1")
-    except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
-        logger.warning(f"Database connection test failed: {e}. Reconnecting...")
-        try:
-            db = psycopg2.connect(**DB_CONFIG)
-            db.autocommit = True
-            logger.info("Database reconnection successful.")
-        except Exception as e:
-            logger.error(f"Database reconnection failed: {e}")
-            
-    return db
+    """Returns the pooled connection bound to the calling thread.
 
-def setup_database():
-    """Initialisation de la base de données."""
-    global db
-    db = connect_to_database()
+    No test query is sent: a connection is only replaced once psycopg2 has
+    marked it closed, or after discard_connection() was called on an error.
+    """
+    key = threading.get_ident()
+    connections = get_pool()
+    db = connections.getconn(key)
+    if db.closed:
+        logger.warning("Database connection lost, reconnecting...")
+        connections.putconn(db, key, close=True)
+        db = connections.getconn(key)
+    if not db.autocommit:
+        db.autocommit = True
     return db
 
 def get_active_connection():
     """Returns an active database connection, reconnecting if necessary."""
-    global db
-    # Force a reconnection if the connection is closed or None
-    if db is None or db.closed:
-        db = connect_to_database()
-    
-    # Test the connection
+    return connect_to_database()
+
+def discard_connection():
+    """Closes the calling thread's connection after an error, the next call gets a fresh one."""
+    if pool is None:
+        return
+    key = threading.get_ident()
     try:
-        with db.cursor() as cursor:
-            cursor.execute("SELECT 1")
-    except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
-        logger.warning(f"Inactive database connection: {e}. Reconnecting...")
-        db = connect_to_database()
-    
-    return db
+        db = pool.getconn(key)
+        pool.putconn(db, key, close=True)
+    except Exception as e:
+        logger.error(f"Failed to discard database connection: {e}")
+
+def release_connection():
+    """Gives the calling thread's connection back to the pool, for threads that stop using the database."""
+    if pool is None:
+        return
+    key = threading.get_ident()
+    try:
+        pool.putconn(pool.getconn(key), key)
+    except Exception as e:
+        logger.error(f"Failed to release database connection: {e}")
 
 def setup_database():
     """Initialisation de la base de données."""
@@ -128,4 +152,4 @@ def setup_database():
         connection.commit()
         logger.info("Database setup completed successfully.")
     except Exception as e:
-        logger.error(f"Database setup failed: {e}")
\ No newline at end of file
+        logger.error(f"Database setup failed: {e}")
@@ -1,107 +1,42 @@
-from .database import connect_to_database, get_active_connection
 from .mqtt_client import publish_to_websocket
-from .lane import getLanesIndexed, LaneCache
+from .lane import LaneCache
 from .vehicle import VehicleCache
-from .traffic_light import getTrafficLightIndexed
-import logging, json
-from .session.registry import trigger_vehicles_update, trigger_lanes_update, trigger_lanes_position, trigger_accidents_update
+from .traffic_light import TrafficLightRegistry
+from .vehicle_ingest import VehicleIngest
+from .accident import AccidentStore
+from .persistence import WriteBehind, Deletion
+from .zone import normalize_zone
+from .metrics import metrics
+from psycopg2.extras import execute_values
+import logging, json, os
+from .session.registry import trigger_lanes_position, trigger_lights_state
 
-class Handler:
-    database = None
+# Jam changes at or below this value are neither recorded nor written
+LANE_JAM_THRESHOLD = float(os.environ.get("LANE_JAM_THRESHOLD", 1e-6))
+
+class Handler(VehicleIngest):
     logger = None
     laneCache = None
     vehicleCache = None
 
     def __init__(self):   
-        self.database = connect_to_database()
         self.laneCache = LaneCache()
         self.vehicleCache = VehicleCache()
+        self.lightRegistry = TrafficLightRegistry()
         self.logger = logging.getLogger(__name__)
+        self.accidentStore = AccidentStore()
 
-    def handle_vehicle_position(self, loop, data):
-        vehicles = self.vehicleCache.getCached()
-        zone = data.get("zone", 0)
-        self.logger.info(f"Handling vehicle position for zone {zone}")
-        
-        # Track vehicles in the current data
-        vehiclesPresent = set()
-        
-        # Prepare batch operations
-        vehicles_to_upsert = []
-        
-        # Process all vehicles first without database operations
-        for vehicle in data.get("data", []):
-            vehicle_id = vehicle['id']
-            vehiclesPresent.add(vehicle_id)
-            
-            # Extract position and other properties
-            lat, lon = vehicle['position'][1], vehicle['position'][0]
-            v_type = vehicle.get('type')
-            angle = vehicle.get('angle')
-            speed = vehicle.get('speed')
-            accident = vehicle.get('accident', False)
-            
-            # Check if vehicle exists and if data has changed
-            if (vehicle_id not in vehicles or 
-                vehicles[vehicle_id]['position'] != [lat, lon] or
-                vehicles[vehicle_id]['type'] != v_type or
-                vehicles[vehicle_id]['angle'] != angle or
-                vehicles[vehicle_id]['speed'] != speed or
-                vehicles[vehicle_id]['accident'] != accident):
-                
-                # Queue for upsert
-                vehicles_to_upsert.append((
-                    vehicle_id, lat, lon, v_type, angle, speed, accident, zone
-                ))
-                
-                # Update cache
-                vehicles[vehicle_id] = {
-                    "id": vehicle_id,
-                    "position": [lat, lon],
-                    "type": v_type,
-                    "angle": angle,
-                    "speed": speed,
-                    "accident": accident,
-                    "zone": zone
-                }
-        
-        # Execute database operations in batches
-        with self.database.cursor() as cursor:
-            # Batch upsert
-            if vehicles_to_upsert:
-                args_str = ','.join(
-                    cursor.mogrify("(%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s, %s, %s, %s)", x).decode('utf-8')
-                    for x in vehicles_to_upsert
-                )
-                cursor.execute(
-                    f"""
-                    INSERT INTO vehicles (id, geom, type, angle, speed, accident, zone)
-                    VALUES {args_str}
-                    ON CONFLICT (id) DO UPDATE SET
-                        geom = EXCLUDED.geom,
-                        type = EXCLUDED.type,
-                        angle = EXCLUDED.angle,
-                        speed = EXCLUDED.speed,
-                        accident = EXCLUDED.accident,
-                        zone = EXCLUDED.zone
-                    """
-                )
-            
-            # Remove vehicles that are no longer present
-            vehicles_to_remove = [vid for vid in vehicles.keys() if vid not in vehiclesPresent]
-            if vehicles_to_remove:
-                format_strings = ','.join(['%s'] * len(vehicles_to_remove))
-                cursor.execute(
-                    f"DELETE FROM vehicles WHERE id IN ({format_strings}) AND zone = %s",
-                    vehicles_to_remove + [zone]
-                )
-                for vehicle_id in vehicles_to_remove:
-                    del vehicles[vehicle_id]
-                    
-            self.database.commit()
-            self.vehicleCache.setCached(vehicles)
-
-        self.logger.debug(f"Vehicle positions updated: {len(vehicles_to_upsert)} upserted, {len(vehicles_to_remove) if 'vehicles_to_remove' in locals() else 0} removed")
+        # Handlers update the memory at once, Postgres is written behind in batches
+        self.persistence = WriteBehind()
+        self.persistence.register("vehicles", self.flush_vehicles)
+        self.persistence.register("lanes", self.flush_lanes)
+        self.persistence.register("lane_jams", self.flush_lane_jams)
+        self.persistence.register("traffic_lights", self.flush_lights)
+        self.persistence.register("traffic_light_states", self.flush_lights_states)
+        self.persistence.register("accidents", self.flush_accidents)
+        self.persistence.start()
+        metrics.gauge("claxon_persist_dirty_rows", self.persistence.depth)
+        metrics.gauge("claxon_vehicles_cached", lambda: len(self.vehicleCache))
 
     def handle_lane_position(self, loop, data):
         self.logger.info(f"Handling lane position data")
@@ -118,166 +53,179 @@ class Handler:
                 return None
         
         # Prepare batch operations
-        lanes_to_insert = []
-        lanes_to_update = []
+        lanes_to_write = {}
+        invalid = []
         
         # Process all lanes first without database operations
         for lane in data["data"]:
             lane['jam'] = 0
             lane_id = lane['id']
             
+            # A lane without a usable shape can be neither cached nor written, it is skipped
+            try:
+                fingerprint = self.laneCache.fingerprint(lane)
+            except (KeyError, TypeError, ValueError, IndexError):
+                invalid.append(lane_id)
+                continue
+
             # Only convert shape to WKT if needed
-            if lane_id not in lanes or lanes[lane_id].get('shape') != lane['shape']:
+            if not self.laneCache.hasShape(lane_id, fingerprint):
                 wkt_shape = to_wkt_multilinestring(lane['shape'])
-                if wkt_shape == "MULTILINESTRING(())":
+                if wkt_shape is None:
+                    invalid.append(lane_id)
                     continue
-                    
-                if lane_id not in lanes:
-                    # Queue for insertion
-                    lanes_to_insert.append((
-                        lane_id,
-                        wkt_shape,
-                        lane.get('priority', 0),
-                        lane.get('type'),
-                        data.get("zone", 0)
-                    ))
-                    lanes[lane_id] = lane
-                else:
-                    # Queue for update
-                    lanes_to_update.append((
-                        wkt_shape,
-                        lane.get('priority', 0),
-                        lane.get('type'),
-                        lane_id
-                    ))
-                    lanes[lane_id] = lane
-        
-        # Execute database operations in batches
-        with self.database.cursor() as cursor:
-            # Batch insert
-            if lanes_to_insert:
-                args_str = ','.join(cursor.mogrify("(%s, ST_SetSRID(ST_GeomFromText(%s), 4326), %s, %s, %s, 0)", x).decode('utf-8') 
-                                   for x in lanes_to_insert)
-                cursor.execute(
-                    f"""
-                    INSERT INTO lanes (id, geom, priority, type, zone, jam)
-                    VALUES {args_str}
-                    """
-                )
-            
-            # Batch update using executemany
-            if lanes_to_update:
-                cursor.executemany(
-                    """
-                    UPDATE lanes SET geom = ST_SetSRID(ST_GeomFromText(%s), 4326), 
-                    priority = %s, type = %s WHERE id = %s
-                    """,
-                    lanes_to_update
+
+                # Queue for insertion, or update of an existing lane
+                lanes_to_write[lane_id] = (
+                    lane_id,
+                    wkt_shape,
+                    lane.get('priority', 0),
+                    lane.get('type'),
+                    data.get("zone", 0)
                 )
-                
-            self.database.commit()
+                self.laneCache.put(lane, fingerprint)
+        
+        self.persistence.mark_many("lanes", lanes_to_write)
+        if invalid:
+            self.logger.warning(f"Skipped {len(invalid)} lanes with an invalid shape, first: {invalid[:5]}")
         
-        logging.info(f"Updated {len(lanes_to_insert) + len(lanes_to_update)} lanes in the database. ({len(lanes)} total lanes cached)")
-        self.laneCache.setCached(lanes)
-        self.logger.info("Lane positions updated in the database.")
+        logging.info(f"Queued {len(lanes_to_write)} lanes for the database. ({len(lanes)} total lanes cached)")
+        self.logger.info("Lane positions updated.")
         
         trigger_lanes_position(loop)
 
+    def flush_lanes(self, cursor, rows):
+        args_str = ','.join(cursor.mogrify("(%s, ST_SetSRID(ST_GeomFromText(%s), 4326), %s, %s, %s, 0)", x).decode('utf-8') 
+                           for x in rows.values())
+        cursor.execute(
+            f"""
+            INSERT INTO lanes (id, geom, priority, type, zone, jam)
+            VALUES {args_str}
+            ON CONFLICT (id) DO UPDATE SET
+                geom = EXCLUDED.geom,
+                priority = EXCLUDED.priority,
+                type = EXCLUDED.type
+            """
+        )
+
     def handle_lane_state(self, loop, data):
         self.logger.debug(f"Handling lane state data")
         lanes = self.laneCache.getCached()
-        # save/replace in the database
-        newData = []
-        with self.database.cursor() as cursor:
-            for lane in data["data"]:
-                if lane['id'] not in lanes:
-                    continue
-                # Check if lane state has changed
-                if lane['traffic_jam'] == lanes[lane['id']]['jam']:
-                    # self.logger.debug(f"No change in traffic jam state for lane {lane['id']}, skipping update.")
-                    continue
-                jam = lane.get('traffic_jam', 0)
-                if jam == None:
-                    jam = 0
-                cursor.execute(
-                    """
-                    UPDATE lanes SET jam = %s WHERE id = %s
-                    """,
-                    (jam, lane['id'])
-                )
-                old = lanes[lane['id']]
-                if "shape" not in lane and "shape" in old:
-                    lane['shape'] = old['shape']
-                lane['jam'] = jam
-                lanes[lane['id']] = lane
-                newData.append(lane)
-            self.database.commit()
-            self.laneCache.setCached(lanes)
+        # save/replace in memory, the database is written behind
+        jams = {}
+        for lane in data["data"]:
+            if lane['id'] not in lanes:
+                continue
+            jam = lane.get('traffic_jam', 0)
+            if jam == None:
+                jam = 0
+            # Check if lane state has changed by more than the threshold
+            if abs(jam - (lanes[lane['id']].get('jam') or 0)) <= LANE_JAM_THRESHOLD:
+                continue
+            jams[lane['id']] = jam
+            old = lanes[lane['id']]
+            if "shape" not in lane and "shape" in old:
+                lane['shape'] = old['shape']
+            lane['jam'] = jam
+            lanes[lane['id']] = lane
+            # Recorded in the step's changeset, sent to sessions on the next traci step
+            self.laneCache.setJam(lane['id'], jam)
+        self.persistence.mark_many("lane_jams", jams)
 
-        self.logger.debug("Lane states updated in the database.")
-        # trigger_lanes_update(loop, newData)
+        self.logger.debug("Lane states updated.")
+
+    def flush_lane_jams(self, cursor, rows):
+        execute_values(
+            cursor,
+            """
+            UPDATE lanes AS l SET jam = v.jam
+            FROM (VALUES %s) AS v(id, jam)
+            WHERE l.id = v.id
+            """,
+            # Floats throughout, so the VALUES column is not inferred as an integer
+            [(lane_id, float(jam)) for lane_id, jam in rows.items()],
+            # One statement for the whole batch, execute_values pages by 100 rows otherwise
+            page_size=len(rows)
+        )
 
     def handle_lights_position(self, loop, data):
         self.logger.debug(f"Handling traffic light position data")
-        # save/replace in the database
-        with self.database.cursor() as cursor:
-            cursor.execute(
-                """
-                DELETE FROM traffic_lights WHERE zone = %s;
-                """, [
-                    data.get("zone", 0)
-                ]
-            )
-            for light in data["data"]:
-                cursor.execute(
-                    """
-                    INSERT INTO traffic_lights (id, geom, in_lane, out_lane, via_lane, zone)
-                    VALUES (%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s, %s, %s)
-                    ON CONFLICT (id) DO UPDATE SET
-                        geom = EXCLUDED.geom,
-                        in_lane = EXCLUDED.in_lane,
-                        out_lane = EXCLUDED.out_lane,
-                        via_lane = EXCLUDED.via_lane,
-                        zone = EXCLUDED.zone
-                    """,
-                    (
-                        light['id'],
-                        light.get('position')[1],
-                        light.get('position')[0],
-                        light.get('in_lane'),
-                        light.get('out_lane'),
-                        light.get('via_lane'),
-                        data.get("zone", 0)
-                    )
-                )
+        zone = normalize_zone(data.get("zone", 0))
+        # Nodes republish their whole topology on restart and first_data, mostly unchanged
+        changed, removed = self.lightRegistry.setZone(zone, data["data"])
+        if not changed and not removed:
+            self.logger.debug(f"Traffic light topology of zone {zone} unchanged.")
+            return
 
-            self.database.commit()
+        lights = {
+            light['id']: (light['id'], light['stop_lon'], light['stop_lat'], light['in_lane'], light['out_lane'], light['via_lane'], zone)
+            for light in changed
+        }
+        lights.update((light_id, Deletion(zone)) for light_id in removed)
+        self.persistence.mark_many("traffic_lights", lights)
 
-        self.logger.debug("Traffic light positions updated in the database.")
+        self.logger.debug(f"Traffic light topology of zone {zone}: {len(changed)} added or moved, {len(removed)} removed.")
         publish_to_websocket(
             loop,
             "traffic_light/position",
             data.get("data", [])
         )
 
+    def flush_lights(self, cursor, rows):
+        lights_to_upsert = []
+        lights_to_remove = {}
+        for light_id, row in rows.items():
+            if isinstance(row, Deletion):
+                lights_to_remove.setdefault(row.zone, []).append(light_id)
+            else:
+                lights_to_upsert.append(row)
+        for zone, light_ids in lights_to_remove.items():
+            cursor.execute(
+                "DELETE FROM traffic_lights WHERE id = ANY(%s) AND zone = %s",
+                (light_ids, zone)
+            )
+        if not lights_to_upsert:
+            return
+        # The state column is left as is, it is only written by state messages
+        execute_values(
+            cursor,
+            """
+            INSERT INTO traffic_lights (id, geom, in_lane, out_lane, via_lane, zone)
+            VALUES %s
+            ON CONFLICT (id) DO UPDATE SET
+                geom = EXCLUDED.geom,
+                in_lane = EXCLUDED.in_lane,
+                out_lane = EXCLUDED.out_lane,
+                via_lane = EXCLUDED.via_lane,
+                zone = EXCLUDED.zone
+            """,
+            lights_to_upsert,
+            template="(%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s, %s, %s)",
+            page_size=len(lights_to_upsert)
+        )
+
     def handle_lights_state(self, loop, data):
         self.logger.debug(f"Handling traffic light state data")
-        # save/replace in the database
-        lights = getTrafficLightIndexed()
-        with self.database.cursor() as cursor:
-            for light in data["data"]:
-                if light['id'] not in lights:
-                    # self.logger.warning(f"Traffic light {light['id']} not found in database, skipping update.")
-                    continue
-                cursor.execute(
-                    """
-                    UPDATE traffic_lights SET state = %s WHERE id = %s
-                    """,
-                    (light['state'], light['id'])
-                )
-            self.database.commit()
+        # Diffed against the registry, unknown lights are skipped
+        changed = self.lightRegistry.applyStates({light['id']: light['state'] for light in data["data"]})
+        if not changed:
+            return
+        self.persistence.mark_many("traffic_light_states", {light['id']: light['state'] for light in changed})
+        trigger_lights_state(loop, changed)
+
+        self.logger.debug(f"{len(changed)} traffic light states changed.")
 
-        self.logger.debug("Traffic light states updated in the database.")
+    def flush_lights_states(self, cursor, rows):
+        execute_values(
+            cursor,
+            """
+            UPDATE traffic_lights AS t SET state = v.state
+            FROM (VALUES %s) AS v(id, state)
+            WHERE t.id = v.id
+            """,
+            list(rows.items()),
+            page_size=len(rows)
+        )
 
     def handle_accidents(self, loop, data):
         """Traite les données relatives aux accidents."""
@@ -285,75 +233,76 @@ class Handler:
         current_step = data.get("current_step", 0)
         zone = data.get("zone", 0)
 
-        self.database = get_active_connection()
-        with self.database.cursor() as cursor:
+        # Préparer les données d'accident
+        accident_list = []
+        if isinstance(data.get("data"), dict) and "data" in data.get("data"):
+            accident_list = data.get("data").get("data", [])
+            zone = data.get("data").get("zone", zone)
+            current_step = data.get("data").get("current_step", current_step)
+        else:
+            self.logger.debug("Probleme format accident")
 
-            # Préparer les données d'accident
-            accident_list = []
-            self.logger.info(f"Data structure received: {type(data)}")
-            self.logger.info(f"Data content: {data}")
-            
-            if isinstance(data.get("data"), dict) and "data" in data.get("data"):
-                accident_list = data.get("data").get("data", [])
-                zone = data.get("data").get("zone", zone)
-                current_step = data.get("data").get("current_step", current_step)
-            else:
-                logging.debug("Probleme format accident")
-            
-            cursor.execute(
-                """
-                SELECT vehicle_id FROM accidents WHERE zone = %s
-                """,
-                (zone,)
+        accidents = []
+        for accident in accident_list:
+            if not isinstance(accident, dict) or 'id' not in accident or len(accident.get('position') or []) < 2:
+                self.logger.error(f"Invalid accident data format: {accident}")
+                continue
+            accidents.append(accident)
+
+        # Diffed against the zone's accidents in memory, only the differences are written
+        zone = normalize_zone(zone)
+        changed, removed = self.accidentStore.setZone(zone, accidents, current_step)
+        rows = {
+            accident['id']: (
+                accident['id'],
+                accident['position'][1],
+                accident['position'][0],
+                accident['type'],
+                accident['start_time'],
+                zone,
+                accident['duration']
             )
-            existing_accident_ids = {row[0] for row in cursor.fetchall()}
+            for accident in changed
+        }
+        rows.update((accident_id, Deletion(zone)) for accident_id in removed)
+        self.persistence.mark_many("accidents", rows)
+        self.logger.debug(f"Accidents of zone {zone}: {len(changed)} added or changed, {len(removed)} removed.")
 
-            # Créer un ensemble des IDs d'accidents reçus
-            current_accident_ids = {accident['id'] for accident in accident_list if isinstance(accident, dict)}
-            
-            # Supprimer uniquement les accidents qui n'existent plus
-            accidents_to_remove = existing_accident_ids - current_accident_ids
-            if accidents_to_remove:
-                self.logger.info(f"Removing {len(accidents_to_remove)} accidents that are no longer present")
-                format_strings = ','.join(['%s'] * len(accidents_to_remove))
-                cursor.execute(
-                    f"DELETE FROM accidents WHERE vehicle_id IN ({format_strings}) AND zone = %s",
-                    list(accidents_to_remove) + [zone]
-                )
-            
-            # Insère ou met à jour les données d'accident
-            for accident in accident_list:
-                logging.info(f"Processing accident {accident.get('id', 'unknown')}")
+    def getAccidents(self):
+        """Returns the accidents of every zone, same output as master.accident.getAccidents."""
+        return self.accidentStore.getAccidents()
 
-                if not isinstance(accident, dict):
-                    self.logger.error(f"Invalid accident data format: {accident}")
-                    continue
-
-                try:
-                    cursor.execute(
-                        """
-                        INSERT INTO accidents (vehicle_id, geom, type, start_time, zone, duration)
-                        VALUES (%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s, %s, %s)
-                        ON CONFLICT (vehicle_id) DO UPDATE SET
-                            geom = EXCLUDED.geom,
-                            type = EXCLUDED.type,
-                            start_time = EXCLUDED.start_time,
-                            duration = EXCLUDED.duration
-                        """,
-                        (
-                            accident['id'],
-                            accident['position'][1],  # latitude
-                            accident['position'][0],  # longitude
-                            accident.get('type'),
-                            accident.get('start_time', 0),
-                            zone,
-                            accident.get('duration', 10)
-                        )
-                    )
-                except Exception as e:
-                    self.logger.error(f"Error inserting accident data: {e}, data: {accident}")
-            
-            self.database.commit()
+    def flush_accidents(self, cursor, rows):
+        accidents_to_upsert = []
+        accidents_to_remove = {}
+        for accident_id, row in rows.items():
+            if isinstance(row, Deletion):
+                accidents_to_remove.setdefault(row.zone, []).append(accident_id)
+            else:
+                accidents_to_upsert.append(row)
+        for zone, accident_ids in accidents_to_remove.items():
+            cursor.execute(
+                "DELETE FROM accidents WHERE vehicle_id = ANY(%s) AND zone = %s",
+                (accident_ids, zone)
+            )
+        if not accidents_to_upsert:
+            return
+        execute_values(
+            cursor,
+            """
+            INSERT INTO accidents (vehicle_id, geom, type, start_time, zone, duration)
+            VALUES %s
+            ON CONFLICT (vehicle_id) DO UPDATE SET
+                geom = EXCLUDED.geom,
+                type = EXCLUDED.type,
+                start_time = EXCLUDED.start_time,
+                zone = EXCLUDED.zone,
+                duration = EXCLUDED.duration
+            """,
+            accidents_to_upsert,
+            template="(%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s, %s, %s)",
+            page_size=len(accidents_to_upsert)
+        )
 
     def send_traffic_light_state_command(self, light_id, new_state):
         from master.mqtt_client import mqtt_client
@@ -0,0 +1,139 @@
+import logging, os, threading, time
+from collections import OrderedDict
+from itertools import count
+from master.metrics import metrics
+from master.zone import zone_of_payload
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of messages waiting to be handled, the oldest are dropped above it
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 1000))
+# Topics carrying a full state per zone: only the latest pending payload of a zone is kept
+COALESCED_TOPICS = set(filter(None, os.environ.get(
+    "INGEST_COALESCED_TOPICS",
+    "claxon/vehicle/position,claxon/accident/position,traci/step"
+).split(",")))
+# Coalesced topics that carry no zone, such as the simulation step, kept once for the whole map
+GLOBAL_TOPICS = set(filter(None, os.environ.get("INGEST_GLOBAL_TOPICS", "traci/step").split(",")))
+# One-off topology topics, coalesced per zone in place and never dropped when the queue is full
+PROTECTED_TOPICS = set(filter(None, os.environ.get(
+    "INGEST_PROTECTED_TOPICS",
+    "claxon/lane/position,claxon/traffic_light/position"
+).split(",")))
+
+class IngestQueue:
+    """Bounded FIFO of (topic, zone, payload) between the MQTT thread and the handlers.
+
+    Messages of a coalesced topic replace the pending message of the same
+    (topic, zone), which moves to the back of the queue. Protected topics
+    replace it in place, so the messages queued after it still follow it.
+    Other messages are kept in arrival order, and so are the messages whose
+    zone cannot be read outside the global topics, so two zones never replace
+    each other's update. When the queue is full the oldest unprotected
+    message is dropped; a node only sends its topology again on restart, so
+    protected messages are never dropped.
+    """
+
+    def __init__(self, maxsize=INGEST_QUEUE_SIZE, coalesced=COALESCED_TOPICS, protected=PROTECTED_TOPICS, globalTopics=GLOBAL_TOPICS):
+        self.maxsize = maxsize
+        self.coalesced = coalesced
+        self.protected = protected
+        self.globalTopics = globalTopics
+        self.pending = OrderedDict()
+        self.sequence = count()
+        self.condition = threading.Condition()
+        self.coalescedCount = {}
+        self.droppedCount = {}
+        self.received = {}
+
+    def put(self, topic, payload):
+        """Queues a message, called from the MQTT network thread."""
+        zone = zone_of_payload(payload)
+        coalescible = zone is not None or topic in self.globalTopics
+        with self.condition:
+            self.received[topic] = self.received.get(topic, 0) + 1
+            metrics.inc("claxon_ingest_messages_total", topic=topic)
+            if coalescible and topic in self.protected and (topic, zone) in self.pending:
+                self.pending[(topic, zone)] = (topic, zone, payload, time.monotonic())
+                self.coalescedCount[topic] = self.coalescedCount.get(topic, 0) + 1
+                metrics.inc("claxon_ingest_coalesced_total", topic=topic)
+                return
+            if coalescible and (topic in self.coalesced or topic in self.protected):
+                key = (topic, zone)
+                if self.pending.pop(key, None) is not None:
+                    self.coalescedCount[topic] = self.coalescedCount.get(topic, 0) + 1
+                    metrics.inc("claxon_ingest_coalesced_total", topic=topic)
+            else:
+                key = next(self.sequence)
+            if len(self.pending) >= self.maxsize:
+                self._evict()
+            self.pending[key] = (topic, zone, payload, time.monotonic())
+            self.condition.notify()
+
+    def _evict(self):
+        """Drops the oldest message that is not protected, the queue grows past maxsize when there is none."""
+        for key, (topic, zone, _, _) in self.pending.items():
+            if topic not in self.protected:
+                break
+        else:
+            return
+        del self.pending[key]
+        self.droppedCount[topic] = self.droppedCount.get(topic, 0) + 1
+        metrics.inc("claxon_ingest_dropped_total", topic=topic)
+        logger.warning(f"Ingest queue full, dropped {topic} message of zone {zone}")
+
+    def get(self, timeout=None):
+        """Returns the oldest (topic, zone, payload, queued_at), None after timeout."""
+        with self.condition:
+            if not self.pending and not self.condition.wait_for(lambda: self.pending, timeout):
+                return None
+            return self.pending.popitem(last=False)[1]
+
+    def depth(self):
+        with self.condition:
+            return len(self.pending)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "depth": len(self.pending),
+                "received": dict(self.received),
+                "coalesced": dict(self.coalescedCount),
+                "dropped": dict(self.droppedCount),
+            }
+
+class IngestWorker:
+    """Thread applying queued messages with handle(topic, payload), one at a time.
+
+    A single worker keeps the handlers' single-writer assumption and the
+    arrival order of each zone's messages.
+    """
+
+    def __init__(self, queue, handle):
+        self.queue = queue
+        self.handle = handle
+        self.stopping = threading.Event()
+        self.thread = None
+        self.handled = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="ingest", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.is_set():
+            message = self.queue.get(timeout=0.5)
+            if message is None:
+                continue
+            topic, zone, payload, queued_at = message
+            metrics.observe("claxon_ingest_wait_seconds", time.monotonic() - queued_at, topic=topic)
+            self.handle(topic, payload)
+            self.handled += 1
@@ -0,0 +1,157 @@
+import json, logging, os, threading, time, zlib
+import multiprocessing
+import queue
+from paho.mqtt.client import Client
+from master.ingest import IngestQueue, IngestWorker
+from master.persistence import WriteBehind
+from master.vehicle import VehicleCache
+from master.vehicle_ingest import VehicleIngest
+from master.zone import normalize_zone, zone_of_payload
+
+logger = logging.getLogger(__name__)
+
+# Number of processes sharing the zones' vehicle positions, 0 handles them in the master process
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 0))
+# Topics handled by the zone workers instead of the master process
+WORKER_TOPICS = ("claxon/vehicle/position",)
+# Seconds a worker gets to flush its write-behind rows on shutdown before it is terminated
+INGEST_WORKER_STOP_TIMEOUT = float(os.environ.get("INGEST_WORKER_STOP_TIMEOUT", 10))
+# Seconds between two checks for zone workers that died
+INGEST_WORKER_CHECK_INTERVAL = float(os.environ.get("INGEST_WORKER_CHECK_INTERVAL", 1))
+
+def zone_owner(zone, workers):
+    """Index of the worker owning a zone, stable across processes."""
+    zone = normalize_zone(zone)
+    if isinstance(zone, int):
+        return zone % workers
+    return zlib.crc32(str(zone).encode('utf-8')) % workers
+
+class ZoneHandler(VehicleIngest):
+    """Vehicle cache, diffing and Postgres writes of the zones owned by one worker."""
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.vehicleCache = VehicleCache()
+        self.persistence = WriteBehind()
+        self.persistence.register("vehicles", self.flush_vehicles)
+        self.persistence.start()
+
+def run_zone_worker(index, workers, host, port, results, stop):
+    """Entry point of a worker process.
+
+    The worker has its own MQTT session and database connection. It drops the
+    messages of zones it does not own, and sends (zone, changed, removed,
+    unchanged) to the master process for each vehicle report it applied. It
+    runs until the stop event is set, then flushes its pending writes.
+    """
+    logging.basicConfig(level=logging.INFO)
+    handler = ZoneHandler()
+    pending = IngestQueue()
+
+    def handle(topic, payload):
+        try:
+            results.put(handler.handle_vehicle_position(None, json.loads(payload)))
+        except Exception as e:
+            logger.error(f"Worker {index} failed to handle {topic}: {e}")
+
+    def on_connect(client, userdata, flags, rc):
+        logger.info(f"Zone worker {index} connected to MQTT broker with result code {rc}")
+        for topic in WORKER_TOPICS:
+            client.subscribe(topic, qos=1)
+
+    def on_message(client, userdata, msg):
+        # Every worker receives every zone, the zone is read without decoding the payload
+        zone = zone_of_payload(msg.payload)
+        if zone_owner(zone if zone is not None else 0, workers) == index:
+            pending.put(msg.topic, msg.payload)
+
+    client = Client(client_id=f"master-ingest-{index}", clean_session=False)
+    client.enable_logger(logger)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host, port, 60)
+    client.loop_start()
+    worker = IngestWorker(pending, handle)
+    worker.start()
+    try:
+        stop.wait()
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        worker.stop()
+        handler.persistence.stop()
+
+class ZoneWorkers:
+    """Worker processes ingesting the vehicle positions, zones sharded by zone_owner.
+
+    Their results are applied to the master's vehicle cache by a reader
+    thread, so sessions are served from the master process as before. The
+    reader also respawns a worker that died, which resumes its MQTT session.
+    """
+
+    def __init__(self, host, port, vehicleCache, workers=INGEST_WORKERS):
+        self.context = multiprocessing.get_context("spawn")
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.vehicleCache = vehicleCache
+        self.results = self.context.Queue()
+        # Asks the workers to stop, the reader stops once they are gone
+        self.stopRequested = self.context.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.processes = [self.spawn(index) for index in range(workers)]
+        self.reader = threading.Thread(target=self.read_results, name="ingest-results", daemon=True)
+
+    def spawn(self, index):
+        return self.context.Process(
+            target=run_zone_worker,
+            args=(index, self.workers, self.host, self.port, self.results, self.stopRequested),
+            name=f"ingest-{index}",
+            daemon=True
+        )
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.reader.start()
+        logger.info(f"Started {len(self.processes)} zone ingest workers")
+
+    def stop(self):
+        """Lets the workers flush their pending writes, terminates the ones that do not exit in time."""
+        with self.lock:
+            self.stopRequested.set()
+        for process in self.processes:
+            # The reader keeps draining the results meanwhile, a worker cannot exit with unflushed queue data
+            process.join(INGEST_WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Zone worker {process.name} did not stop in {INGEST_WORKER_STOP_TIMEOUT}s, terminating it")
+                process.terminate()
+                process.join()
+        self.stopping.set()
+        self.reader.join()
+
+    def check_workers(self):
+        """Respawns the workers that exited while the master is running."""
+        with self.lock:
+            if self.stopRequested.is_set():
+                return
+            for index, process in enumerate(self.processes):
+                if process.exitcode is None:
+                    continue
+                logger.error(f"Zone worker {process.name} exited with code {process.exitcode}, respawning it")
+                self.processes[index] = self.spawn(index)
+                self.processes[index].start()
+
+    def read_results(self):
+        nextCheck = time.monotonic() + INGEST_WORKER_CHECK_INTERVAL
+        while not self.stopping.is_set():
+            if time.monotonic() >= nextCheck:
+                self.check_workers()
+                nextCheck = time.monotonic() + INGEST_WORKER_CHECK_INTERVAL
+            try:
+                zone, changed, removed, unchanged = self.results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.vehicleCache.applyChanges(zone, changed, removed)
+            self.vehicleCache.setZoneStats(zone, len(changed), len(removed), unchanged)
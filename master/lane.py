@@ -1,19 +1,191 @@
 from master.database import connect_to_database
-import json
+from master.spatial import PackedRTree, bbox_of, bbox_intersects, simplify
+import json, os, threading
+
+# Decimal places kept when fingerprinting shapes, ~1 cm, below the precision of ST_AsGeoJSON
+LANE_FINGERPRINT_DIGITS = 7
+
+# Douglas-Peucker tolerances in degrees of the simplified lane levels, level 0 is the full shape
+LANE_SIMPLIFY_TOLERANCES = [float(t) for t in os.environ.get("LANE_SIMPLIFY_TOLERANCES", "0.000005,0.00002,0.0001").split(",") if t]
+# Width of a frame in screen pixels, a frame's level is the coarsest one whose tolerance fits in a pixel
+LANE_SIMPLIFY_PIXELS = int(os.environ.get("LANE_SIMPLIFY_PIXELS", 2000))
+
+def simplification_level(minX, minY, maxX, maxY):
+    """Index in LANE_SIMPLIFY_TOLERANCES of the level to send for a frame, -1 for the full shapes."""
+    pixel = max(abs(maxX - minX), abs(maxY - minY)) / LANE_SIMPLIFY_PIXELS
+    level = -1
+    for index, tolerance in enumerate(LANE_SIMPLIFY_TOLERANCES):
+        if tolerance <= pixel:
+            level = index
+    return level
+
+def shape_fingerprint(points):
+    """Hash of a polyline given as (x, y) pairs, equal for the node's and the database's copies."""
+    return hash(tuple((round(x, LANE_FINGERPRINT_DIGITS), round(y, LANE_FINGERPRINT_DIGITS)) for x, y in points))
+
+def encode_lane_geometry(record, shape=None):
+    """JSON members of a lane record except its jam, which changes every step."""
+    return '"id": %s, "shape": %s, "priority": %s, "type": %s' % (
+        json.dumps(record['id']), json.dumps(record['shape'] if shape is None else shape), json.dumps(record['priority']), json.dumps(record['type'])
+    )
+
+def simplified_fragments(record):
+    """Encoded geometry of a lane record at each simplification level, None where it is too small to show."""
+    shape = record.get('shape') or []
+    if len(shape) < 2:
+        return [None for _ in LANE_SIMPLIFY_TOLERANCES]
+    box = bbox_of(shape)
+    size = max(box[2] - box[0], box[3] - box[1])
+    return [
+        encode_lane_geometry(record, simplify(shape, tolerance)) if size >= tolerance else None
+        for tolerance in LANE_SIMPLIFY_TOLERANCES
+    ]
 
 class LaneCache:
+    """Lanes by id, with their shape fingerprint and pre-encoded JSON geometry.
+
+    The fingerprint makes shape change detection a single comparison, and the
+    encoded geometry is only rebuilt when it changes, so lanes/position
+    payloads are joined from cached fragments. Simplified levels are encoded
+    along with the full geometry, on the ingest thread, so sessions only look
+    them up; a lane smaller than a level's tolerance has no fragment (None) at
+    that level and is left out.
+    """
     lanes = {}
+    records = {}
+    fingerprints = {}
+    fragments = {}
+    levels = []
+    index = None
+    changes = {}
 
     def __init__(self):
-        self.lanes = getLanesIndexed()
+        self.index = PackedRTree()
+        self.changes = {}
+        self.changesLock = threading.Lock()
+        self.setCached(getLanesIndexed())
 
     def getCached(self):
         return self.lanes
     
     def setCached(self, lanes):
+        """Replaces the cached lanes and bulk loads the index over their bounding boxes."""
+        # Lanes read from the database already hold their shape as GeoJSON coordinates
+        records = {lane_id: dict(lane) for lane_id, lane in lanes.items()}
+        levels = [{} for _ in LANE_SIMPLIFY_TOLERANCES]
+        for lane_id, record in records.items():
+            for fragments, fragment in zip(levels, simplified_fragments(record)):
+                fragments[lane_id] = fragment
         self.lanes = lanes
-    
+        self.fingerprints = {
+            lane_id: shape_fingerprint((pt[0], pt[1]) for pt in record.get('shape') or [])
+            for lane_id, record in records.items()
+        }
+        self.fragments = {lane_id: encode_lane_geometry(record) for lane_id, record in records.items()}
+        self.levels = levels
+        self.records = records
+        self.index.build(
+            (lane_id, bbox_of(record['shape']))
+            for lane_id, record in records.items()
+            if len(record.get('shape') or []) >= 2
+        )
+
+    def fingerprint(self, lane):
+        """Fingerprint of the shape of a lane received from a node."""
+        # Nodes send [y, x] points
+        return shape_fingerprint((pt[1], pt[0]) for pt in lane['shape'])
+
+    def hasShape(self, lane_id, fingerprint):
+        return lane_id in self.records and self.fingerprints.get(lane_id) == fingerprint
 
+    def put(self, lane, fingerprint=None):
+        """Stores a lane received from a node, indexes its shape and encodes its geometry."""
+        self.lanes[lane['id']] = lane
+        # Nodes send [y, x] points, the database (and getLanesIn) use [x, y]
+        record = {
+            "id": lane['id'],
+            "shape": [[pt[1], pt[0]] for pt in lane['shape']],
+            "priority": lane.get('priority', 0),
+            "type": lane.get('type'),
+            "jam": lane.get('jam', 0)
+        }
+        simplified = simplified_fragments(record)
+        self.fingerprints[lane['id']] = fingerprint if fingerprint is not None else self.fingerprint(lane)
+        self.fragments[lane['id']] = encode_lane_geometry(record)
+        for fragments, fragment in zip(self.levels, simplified):
+            fragments[lane['id']] = fragment
+        self.records[lane['id']] = record
+        if len(record['shape']) >= 2:
+            self.index.insert(lane['id'], bbox_of(record['shape']))
+        else:
+            self.index.remove(lane['id'])
+
+    def setJam(self, lane_id, jam):
+        """Updates a lane's jam and records it in the changeset of the current step."""
+        record = self.records.get(lane_id)
+        if record is not None:
+            record['jam'] = jam
+            with self.changesLock:
+                self.changes[lane_id] = jam
+
+    def popChanges(self):
+        """Returns the lane jams changed since the last call, as {id: jam}."""
+        with self.changesLock:
+            changes, self.changes = self.changes, {}
+        return changes
+
+    def getLaneStatesChangedIn(self, changes, minX, minY, maxX, maxY):
+        """Returns {id, state} for the changed lanes intersecting the bounding box."""
+        if minX is None or maxX is None:
+            return []
+        xmin, ymin, xmax, ymax = min(minX, maxX), min(minY, maxY), max(minX, maxX), max(minY, maxY)
+        states = []
+        for lane_id, jam in changes.items():
+            box = self.index.get(lane_id)
+            if box is not None and bbox_intersects(box, xmin, ymin, xmax, ymax):
+                states.append({"id": lane_id, "state": jam})
+        return states
+
+    def getLanesIn(self, minX, minY, maxX, maxY):
+        """Same output as getLanesIn, answered by the lane R-tree."""
+        if minX is None or maxX is None:
+            return []
+        records = self.records
+        keys = self.index.query(min(minX, maxX), min(minY, maxY), max(minX, maxX), max(minY, maxY))
+        return [records[key] for key in keys if key in records]
+
+    def getSimplifiedFragment(self, lane_id, level):
+        """Encoded geometry of a lane at a simplification level, None when the lane is too small to show."""
+        fragments = self.levels[level]
+        if lane_id in fragments:
+            return fragments[lane_id]
+        # Only for a lane read while setCached swaps the levels, not worth caching
+        return simplified_fragments(self.records[lane_id])[level]
+
+    def getLanesInEncoded(self, minX, minY, maxX, maxY, level=None):
+        """Same output as getLanesIn, as a JSON array joined from the encoded geometries.
+
+        Shapes are simplified to the level the frame's span selects, unless a level is given.
+        """
+        if minX is None or maxX is None:
+            return "[]"
+        if level is None:
+            level = simplification_level(minX, minY, maxX, maxY)
+        records = self.records
+        keys = self.index.query(min(minX, maxX), min(minY, maxY), max(minX, maxX), max(minY, maxY))
+        if level < 0:
+            fragments = self.fragments
+            found = ((key, fragments.get(key)) for key in keys if key in records)
+        else:
+            found = ((key, self.getSimplifiedFragment(key, level)) for key in keys if key in records)
+        return "[" + ", ".join(
+            '{%s, "jam": %s}' % (fragment, json.dumps(records[key]['jam']))
+            for key, fragment in found if fragment is not None
+        ) + "]"
+
+    def getLaneStatesIn(self, minX, minY, maxX, maxY):
+        """Returns {id, state} for the lanes intersecting the bounding box."""
+        return [{"id": lane["id"], "state": lane["jam"]} for lane in self.getLanesIn(minX, minY, maxX, maxY)]
 
 
 def getLanes():
@@ -60,4 +232,4 @@ def getLanesIn(minX, minY, maxX, maxY):
                 "type": lane[3],
                 "jam": lane[4]
             })
-    return lanesFormatted
\ No newline at end of file
+    return lanesFormatted
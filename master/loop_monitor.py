@@ -0,0 +1,32 @@
+import asyncio, logging, os, time
+
+logger = logging.getLogger(__name__)
+
+# Interval between two event loop probes, in seconds
+LOOP_MONITOR_INTERVAL = float(os.environ.get("LOOP_MONITOR_INTERVAL", 0.5))
+# Lag above which a warning is logged, in seconds
+LOOP_LAG_WARNING = float(os.environ.get("LOOP_LAG_WARNING", 0.1))
+
+class LoopLag:
+    """Latest and worst delay observed between a probe's deadline and its wake up."""
+    last = 0.0
+    max = 0.0
+    samples = 0
+
+    def reset_max(self):
+        worst, self.max = self.max, 0.0
+        return worst
+
+loop_lag = LoopLag()
+
+async def monitor_event_loop(interval=LOOP_MONITOR_INTERVAL):
+    """Sleeps for interval in a loop and records how late it wakes up."""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - start - interval)
+        loop_lag.last = lag
+        loop_lag.max = max(loop_lag.max, lag)
+        loop_lag.samples += 1
+        if lag > LOOP_LAG_WARNING:
+            logger.warning(f"Event loop lagged by {lag * 1000:.1f} ms")
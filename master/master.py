@@ -4,12 +4,15 @@ from .database import setup_database
 from .handler import setup_handler
 from .mqtt_client import setup_mqtt_client, close_mqtt_client
 from .websocket_server import start_websocket_server
+from .ingest_worker import INGEST_WORKERS, ZoneWorkers
 
 logger = logging.getLogger(__name__)
 
 def main(host, port):
     """Point d'entrée principal."""
     mqtt_client = None
+    handler = None
+    workers = None
     try:
         logger.info("Starting Claxon Master Controller...")
         setup_database()
@@ -22,7 +25,12 @@ def main(host, port):
         mqtt_client = setup_mqtt_client(host, port, loop)
         from . import mqtt_client as mqtt_module  # ← on importe le module pour y écrire dedans
 
-        setup_handler()
+        handler = setup_handler()
+
+        # Vehicle positions are diffed and written by worker processes, one set of zones each
+        if INGEST_WORKERS > 0:
+            workers = ZoneWorkers(host, port, handler.vehicleCache)
+            workers.start()
 
         loop.run_until_complete(start_websocket_server())
     except KeyboardInterrupt:
@@ -30,5 +38,9 @@ def main(host, port):
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
     finally:
+        if workers != None:
+            workers.stop()
         if mqtt_client != None:
-            close_mqtt_client(mqtt_client)
\ No newline at end of file
+            close_mqtt_client(mqtt_client)
+        if handler != None:
+            handler.persistence.stop()
\ No newline at end of file
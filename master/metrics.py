@@ -0,0 +1,157 @@
+import asyncio, bisect, logging, os, re, threading, time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Port of the HTTP server exposing /metrics in the Prometheus text format
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 7901))
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"'.replace("\n", " ") for key, value in labels) + "}"
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of the observed values."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+class Metrics:
+    """Process-wide counters, histograms and gauges, safe to update from any thread.
+
+    Gauges are read when rendering: a gauge is a function returning a value,
+    or a list of (labels, value) pairs where labels is a dict.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the duration of the block into the histogram name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            rendered = [(name, histogram.render(name, labels)) for (name, labels), histogram in histograms]
+
+        def header(name, kind):
+            lines.append(f"# TYPE {name} {kind}")
+
+        previous = None
+        for (name, labels), value in counters:
+            if name != previous:
+                header(name, "counter")
+                previous = name
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, histogramLines in rendered:
+            if name != previous:
+                header(name, "histogram")
+                previous = name
+            lines.extend(histogramLines)
+        for name, read in sorted(self.gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                logger.error(f"Failed to read gauge {name}: {e}")
+                continue
+            header(name, "gauge")
+            if isinstance(value, list):
+                for labels, sample in value:
+                    lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {sample}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+STATEMENT = re.compile(r"^\s*(INSERT INTO|UPDATE|DELETE FROM|SELECT|CREATE TEMP TABLE IF NOT EXISTS|CREATE TABLE IF NOT EXISTS|[A-Z]+)\s*(\w*)", re.IGNORECASE)
+SELECT_FROM = re.compile(r"\bFROM\s+(\w+)", re.IGNORECASE)
+
+def statement_label(query):
+    """Short label of a query, its verb and table, e.g. "UPDATE lanes"."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    match = STATEMENT.match(query)
+    if match is None:
+        return "other"
+    verb, table = match.group(1).upper(), match.group(2)
+    if verb == "SELECT":
+        selected = SELECT_FROM.search(query)
+        table = selected.group(1) if selected else ""
+    elif verb.startswith("CREATE"):
+        verb = "CREATE"
+    return f"{verb} {table}".strip()
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        logger.debug(f"Metrics request aborted: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(port=METRICS_PORT):
+    server = await asyncio.start_server(handle_metrics_request, "0.0.0.0", port)
+    logger.info(f"Metrics served on port {port}")
+    return server
@@ -1,12 +1,21 @@
 import json, master.handler
 import logging
 from master.session.registry import get_sessions
+from master.snapshot import build_step_snapshot
+from master.database import discard_connection
+from master.ingest import IngestQueue, IngestWorker
+from master.ingest_worker import INGEST_WORKERS, WORKER_TOPICS
+from master.metrics import metrics
 from paho.mqtt.client import Client
 import asyncio
+import psycopg2
 
 from master.websocket_server import broadcast_websocket_message
 mqtt_client = None
+ingest_queue = IngestQueue()
+ingest_worker = None
 logger = logging.getLogger(__name__)
+metrics.gauge("claxon_ingest_queue_depth", ingest_queue.depth)
 
 def publish_to_websocket(loop, message_type, data, dump_json=False):
     asyncio.run_coroutine_threadsafe(
@@ -15,13 +24,21 @@ def publish_to_websocket(loop, message_type, data, dump_json=False):
     )
 
 def handle_traci_step(loop):
-    s = get_sessions().copy()
-    logger.info(f"Handling traci step for {len(s)} sessions.")
-    for session in s:
-        session.trigger_vehicle_update(loop)
-        session.trigger_lane_update(loop)
-        session.trigger_accidents_update(loop)
-    logger.info("All sessions updated with new vehicle and lane data.")
+    with metrics.timer("claxon_traci_step_seconds"):
+        s = get_sessions().copy()
+        logger.info(f"Handling traci step for {len(s)} sessions.")
+        if not any(session.focused for session in s):
+            return
+        try:
+            snapshot = build_step_snapshot(master.handler.handler)
+        except Exception as e:
+            logger.error(f"Failed to build step snapshot: {e}")
+            return
+        for session in s:
+            session.trigger_vehicle_update(loop, snapshot)
+            session.trigger_lane_update(loop, snapshot)
+            session.trigger_accidents_update(loop, snapshot)
+        logger.info("All sessions updated with new vehicle and lane data.")
 
 SUBSCRIBER_TOPICS = {
     "claxon/lane/position": lambda client, loop, msg: master.handler.handler.handle_lane_position(loop, json.loads(msg)),
@@ -33,8 +50,19 @@ SUBSCRIBER_TOPICS = {
     "traci/step": lambda client, loop, msg: handle_traci_step(loop),
 }
 
+def handle_message(client, loop, topic, payload):
+    """Applies one queued message, runs on the ingest worker thread."""
+    try:
+        with metrics.timer("claxon_handler_seconds", topic=topic):
+            SUBSCRIBER_TOPICS[topic](client, loop, payload)
+    except (psycopg2.InterfaceError, psycopg2.OperationalError) as e:
+        logger.error(f"Database error while handling {topic}: {e}")
+        discard_connection()
+    except Exception as e:
+        logger.error(f"Error while handling {topic}: {e}")
+
 def setup_mqtt_client(host, port, loop = None):
-    global mqtt_client
+    global mqtt_client, ingest_worker
     """Configuration et démarrage du client MQTT."""
     client = Client(client_id="master", clean_session=False)
     if loop is None:
@@ -44,19 +72,25 @@ def setup_mqtt_client(host, port, loop = None):
     def on_connect(client, userdata, flags, rc):
         logger.info(f"Connected to MQTT broker with result code {rc}")
         for topic in SUBSCRIBER_TOPICS.keys():
+            # Zone workers subscribe to their topics themselves, the session may still hold them
+            if INGEST_WORKERS > 0 and topic in WORKER_TOPICS:
+                client.unsubscribe(topic)
+                continue
             client.subscribe(topic, qos=1)
 
         client.publish("claxon/command/first_data", "")
 
     def on_message(client, userdata, msg):
-        for topic in SUBSCRIBER_TOPICS.keys():
-            if msg.topic == topic:
-                SUBSCRIBER_TOPICS[topic](client, loop, msg.payload)
-
+        # Only queue here, so that slow handlers never hold up acks and keepalives
+        if msg.topic in SUBSCRIBER_TOPICS:
+            ingest_queue.put(msg.topic, msg.payload)
 
     client.on_connect = on_connect
     client.on_message = on_message
 
+    ingest_worker = IngestWorker(ingest_queue, lambda topic, payload: handle_message(client, loop, topic, payload))
+    ingest_worker.start()
+
     client.connect(host, port, 60)
     client.loop_start()
     return client
@@ -65,4 +99,6 @@ def close_mqtt_client(client):
     """Arrête le client MQTT."""
     client.loop_stop()
     client.disconnect()
+    if ingest_worker is not None:
+        ingest_worker.stop()
     logger.info("MQTT client disconnected.")
\ No newline at end of file
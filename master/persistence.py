@@ -0,0 +1,140 @@
+import logging, os, threading, time
+from collections import namedtuple
+import psycopg2
+from master.database import connect_to_database, discard_connection
+from master.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two flushes of the dirty rows, 0 writes through on the ingesting thread
+PERSIST_INTERVAL = float(os.environ.get("PERSIST_INTERVAL", 0.5))
+# Dirty rows above which each flush logs a warning
+PERSIST_DEPTH_WARNING = int(os.environ.get("PERSIST_DEPTH_WARNING", 100000))
+
+# Dirty value of a row to delete, scoped to the zone that removed it
+Deletion = namedtuple("Deletion", "zone")
+
+class WriteBehind:
+    """Postgres as a durability sink behind the in-memory state.
+
+    Handlers mark rows dirty per table, keyed by primary key so only the
+    latest value of a row is written. A background thread flushes every table
+    in one transaction each interval (group commit). When the connection
+    fails, the rows are put back unless they were marked again in the
+    meantime; a table whose rows the database rejects has its batch dropped,
+    the other tables are still written.
+    """
+
+    def __init__(self, interval=PERSIST_INTERVAL):
+        self.interval = interval
+        self.tables = {}
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+        self.flushed = 0
+        self.failures = 0
+
+    def register(self, table, flush):
+        """Registers flush(cursor, rows) for a table, tables are flushed in registration order."""
+        self.tables[table] = flush
+        self.dirty[table] = {}
+
+    def mark_many(self, table, rows):
+        if not rows:
+            return
+        with self.lock:
+            self.dirty[table].update(rows)
+        if self.interval <= 0:
+            self.flush()
+
+    def depth(self):
+        """Number of dirty rows waiting to be written."""
+        with self.lock:
+            return sum(len(rows) for rows in self.dirty.values())
+
+    def start(self):
+        if self.interval <= 0 or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the flusher after a last flush."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            depth = self.depth()
+            if depth > PERSIST_DEPTH_WARNING:
+                self.logger.warning(f"Write-behind queue holds {depth} dirty rows")
+            self.flush()
+
+    def flush_table(self, cursor, table, flush, rows):
+        """Writes one table's batch behind a savepoint, returns False when the database rejected it.
+
+        A rejected batch is dropped alone, the other tables of the transaction
+        are still committed. Connection errors are raised to fail the flush.
+        """
+        cursor.execute("SAVEPOINT write_behind_table")
+        try:
+            with metrics.timer("claxon_persist_flush_seconds", table=table):
+                flush(cursor, rows)
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            raise
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT write_behind_table")
+            self.failures += 1
+            metrics.inc("claxon_persist_failures_total", table=table)
+            # Retrying rows the database rejected would fail every flush after this one
+            self.logger.error(f"Write-behind flush of {table} failed, {len(rows)} rows dropped: {e}")
+            return False
+        cursor.execute("RELEASE SAVEPOINT write_behind_table")
+        return True
+
+    def flush(self):
+        with self.lock:
+            batches = {table: rows for table, rows in self.dirty.items() if rows}
+            for table in batches:
+                self.dirty[table] = {}
+        if not batches:
+            return
+
+        start = time.monotonic()
+        try:
+            db = connect_to_database()
+            with db.cursor() as cursor:
+                cursor.execute("BEGIN")
+                try:
+                    for table, flush in self.tables.items():
+                        if table in batches and not self.flush_table(cursor, table, flush, batches[table]):
+                            del batches[table]
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            self.failures += 1
+            metrics.inc("claxon_persist_failures_total")
+            if not isinstance(e, (psycopg2.InterfaceError, psycopg2.OperationalError)):
+                self.logger.error(f"Write-behind flush failed, {sum(len(rows) for rows in batches.values())} rows dropped: {e}")
+                return
+            self.logger.error(f"Write-behind flush failed, rows kept for the next one: {e}")
+            discard_connection()
+            with self.lock:
+                for table, rows in batches.items():
+                    # Rows marked again since this flush started are newer than the failed ones
+                    for key, row in rows.items():
+                        self.dirty[table].setdefault(key, row)
+            return
+
+        count = sum(len(rows) for rows in batches.values())
+        self.flushed += count
+        for table, rows in batches.items():
+            metrics.inc("claxon_persist_rows_total", len(rows), table=table)
+        self.logger.debug(f"Write-behind flushed {count} rows in {(time.monotonic() - start) * 1000:.1f} ms")
@@ -0,0 +1,140 @@
+import json, os, struct
+
+def encode_message(message_type, data, dump_json=False):
+    """Serializes a {type, data} message once so the result can be written to any number of sessions.
+
+    With dump_json=True, data is already a JSON document and is spliced in as is
+    instead of being parsed and encoded again.
+    """
+    if dump_json:
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return '{"type": %s, "data": %s}' % (json.dumps(message_type), data)
+    return json.dumps({
+        "type": message_type,
+        "data": data
+    })
+
+# Binary frames, little endian:
+#   header   u8 kind, u8 version, u8 flags, u32 seq, u32 new string count
+#   strings  u16 byte length + utf-8 bytes, appended to the session's string table in order
+#   u32 record count, then fixed size records
+# With BINARY_FLAG_RESET the client empties its string table before reading the strings.
+BINARY_VERSION = 2
+BINARY_KIND_VEHICLE = 1
+BINARY_KIND_LANE_STATE = 2
+BINARY_FLAG_RESET = 1
+BINARY_NO_STRING = 0xFFFFFFFF
+
+# Strings a session's table may hold, the table restarts from the frame's strings above it
+BINARY_STRING_TABLE_MAX = int(os.environ.get("BINARY_STRING_TABLE_MAX", 100000))
+
+BINARY_HEADER = struct.Struct("<BBBII")
+BINARY_STRING_LENGTH = struct.Struct("<H")
+BINARY_COUNT = struct.Struct("<I")
+# id, type, x, y, angle, speed, accident
+BINARY_VEHICLE = struct.Struct("<IIddffB")
+# id, jam
+BINARY_LANE_STATE = struct.Struct("<If")
+
+class BinaryEncoder:
+    """Packs vehicle and lane/state frames into fixed size binary records for one session.
+
+    Ids and types are replaced by indexes in a string table kept per session;
+    strings are sent once, inline, in the first frame that uses them, so frames
+    must reach the client in the order they were encoded. The table and seq
+    only change once a frame is packed, a frame that fails to encode leaves
+    them as the client knows them.
+    """
+
+    def __init__(self, maxStrings=BINARY_STRING_TABLE_MAX):
+        self.strings = {}
+        self.seq = 0
+        self.maxStrings = maxStrings
+        self.resetPending = False
+
+    def request_reset(self):
+        """Makes the next frame restart the client's string table, after a resync."""
+        self.resetPending = True
+
+    def _string(self, value, strings, newStrings):
+        if value is None:
+            return BINARY_NO_STRING
+        index = strings.get(value)
+        if index is None:
+            index = newStrings.get(value)
+            if index is None:
+                index = len(strings) + len(newStrings)
+                newStrings[value] = index
+        return index
+
+    def _encode(self, kind, build, recordStruct):
+        """Packs the records build(string) returns, string mapping a value to its table index."""
+        strings = {} if self.resetPending else self.strings
+        newStrings = {}
+        records = build(lambda value: self._string(value, strings, newStrings))
+        flags = BINARY_FLAG_RESET if self.resetPending else 0
+        if len(strings) + len(newStrings) > self.maxStrings:
+            # Starting over keeps the table to the strings still in use
+            strings = {}
+            newStrings = {}
+            records = build(lambda value: self._string(value, strings, newStrings))
+            flags = BINARY_FLAG_RESET
+        frame = self._frame(kind, flags, self.seq + 1, newStrings, records, recordStruct)
+        if flags & BINARY_FLAG_RESET:
+            self.strings = {}
+        self.strings.update(newStrings)
+        self.seq += 1
+        self.resetPending = False
+        return frame
+
+    def _frame(self, kind, flags, seq, newStrings, records, recordStruct):
+        # newStrings is ordered by index, as dicts keep insertion order
+        encodedStrings = [string.encode('utf-8') for string in newStrings]
+        size = (
+            BINARY_HEADER.size
+            + sum(BINARY_STRING_LENGTH.size + len(string) for string in encodedStrings)
+            + BINARY_COUNT.size
+            + recordStruct.size * len(records)
+        )
+        buffer = bytearray(size)
+        BINARY_HEADER.pack_into(buffer, 0, kind, BINARY_VERSION, flags, seq & 0xFFFFFFFF, len(encodedStrings))
+        offset = BINARY_HEADER.size
+        for string in encodedStrings:
+            BINARY_STRING_LENGTH.pack_into(buffer, offset, len(string))
+            offset += BINARY_STRING_LENGTH.size
+            buffer[offset:offset + len(string)] = string
+            offset += len(string)
+        BINARY_COUNT.pack_into(buffer, offset, len(records))
+        offset += BINARY_COUNT.size
+        for record in records:
+            recordStruct.pack_into(buffer, offset, *record)
+            offset += recordStruct.size
+        return bytes(buffer)
+
+    def encode_vehicles(self, vehicles):
+        def build(string):
+            records = []
+            for vehicle in vehicles:
+                position = vehicle.get("position") or (None, None)
+                records.append((
+                    string(vehicle["id"]),
+                    string(vehicle.get("type")),
+                    _float(position[0]),
+                    _float(position[1]),
+                    _float(vehicle.get("angle")),
+                    _float(vehicle.get("speed")),
+                    1 if vehicle.get("accident") else 0
+                ))
+            return records
+        return self._encode(BINARY_KIND_VEHICLE, build, BINARY_VEHICLE)
+
+    def encode_lane_states(self, states):
+        def build(string):
+            return [(string(state["id"]), _float(state.get("state"))) for state in states]
+        return self._encode(BINARY_KIND_LANE_STATE, build, BINARY_LANE_STATE)
+
+NAN = float("nan")
+
+def _float(value):
+    return NAN if value is None else value
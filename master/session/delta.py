@@ -0,0 +1,67 @@
+import os
+
+# Number of steps between two full vehicle keyframes on a delta stream
+VEHICLE_KEYFRAME_INTERVAL = int(os.environ.get("VEHICLE_KEYFRAME_INTERVAL", 50))
+
+VEHICLE_DELTA_FIELDS = ("position", "type", "angle", "speed", "accident")
+
+class VehicleDeltaEncoder:
+    """Turns the vehicle list of a session into deltas against what it last received.
+
+    Each frame carries a sequence number so the client can detect a gap and ask
+    for a resync; a full keyframe is sent every VEHICLE_KEYFRAME_INTERVAL frames
+    and whenever one is requested.
+    """
+
+    def __init__(self, keyframeInterval=VEHICLE_KEYFRAME_INTERVAL):
+        self.keyframeInterval = keyframeInterval
+        self.sent = {}
+        self.seq = 0
+        self.sinceKeyframe = 0
+        self.forceKeyframe = True
+
+    def request_keyframe(self):
+        self.forceKeyframe = True
+
+    def encode(self, vehicles):
+        """Returns the vehicle/delta payload for this step and remembers what was sent."""
+        self.seq += 1
+        current = {vehicle['id']: vehicle for vehicle in vehicles}
+
+        if self.forceKeyframe or self.sinceKeyframe >= self.keyframeInterval:
+            self.forceKeyframe = False
+            self.sinceKeyframe = 0
+            self.sent = current
+            return {
+                "seq": self.seq,
+                "keyframe": True,
+                "vehicles": vehicles
+            }
+
+        added = []
+        changed = []
+        sent = self.sent
+        for vehicle_id, vehicle in current.items():
+            previous = sent.get(vehicle_id)
+            if previous is None:
+                added.append(vehicle)
+            # The vehicle cache replaces a vehicle's dict when it changes, same object means same values
+            elif previous is not vehicle:
+                fields = {
+                    field: vehicle.get(field) for field in VEHICLE_DELTA_FIELDS
+                    if previous.get(field) != vehicle.get(field)
+                }
+                if fields:
+                    fields["id"] = vehicle_id
+                    changed.append(fields)
+        removed = [vehicle_id for vehicle_id in sent if vehicle_id not in current]
+
+        self.sinceKeyframe += 1
+        self.sent = current
+        return {
+            "seq": self.seq,
+            "keyframe": False,
+            "added": added,
+            "removed": removed,
+            "changed": changed
+        }
@@ -0,0 +1,44 @@
+import asyncio, threading, time
+from collections import OrderedDict
+
+class Outbox:
+    """Outbound queue of one session, keyed by message type with latest-wins replacement.
+
+    Producers on any thread put encoded frames, or callables producing one when
+    the frame depends on what the session actually received (delta and binary
+    streams). A single writer task drains the queue, so a slow client skips the
+    stale frames instead of piling them up; the queue never holds more than one
+    frame per message type.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.ready = asyncio.Event()
+        self.replaced = 0
+        self.lag = 0.0
+
+    def put(self, message_type, frame):
+        """Queues a frame, returns True when it replaced one that was never sent."""
+        with self.lock:
+            replaced = message_type in self.pending
+            if replaced:
+                self.replaced += 1
+            self.pending[message_type] = (frame, time.monotonic())
+        self.loop.call_soon_threadsafe(self.ready.set)
+        return replaced
+
+    def depth(self):
+        return len(self.pending)
+
+    async def get(self):
+        """Waits for the oldest queued message type, returns (message_type, frame)."""
+        while True:
+            with self.lock:
+                if self.pending:
+                    message_type, (frame, queuedAt) = self.pending.popitem(last=False)
+                    self.lag = time.monotonic() - queuedAt
+                    return message_type, frame
+                self.ready.clear()
+            await self.ready.wait()
@@ -1,5 +1,4 @@
 import logging
-from master.lane import getLanesIndexed
 
 sessions = set()
 
@@ -24,30 +23,6 @@ def get_sessions():
     global sessions
     return sessions
 
-def trigger_vehicles_update(loop):
-    """Trigger an update for all sessions."""
-    global sessions
-    logger.debug("Triggering vehicles update for all sessions.")
-    sess = sessions.copy()  # Create a copy to avoid modifying the set during iteration
-    for session in sess:
-        try:
-            session.trigger_vehicle_update(loop)
-        except Exception as e:
-            session.logger.error(f"Failed to send vehicles update: {e}")
-            remove_session(session)
-
-def trigger_lanes_update(loop, updatedData):
-    """Trigger an update for all sessions."""
-    global sessions
-    logger.debug("Triggering lanes update for all sessions.")
-    sess = sessions.copy()  # Create a copy to avoid modifying the set during iteration
-    for session in sess:
-        try:
-            session.trigger_lane_update(loop, updatedData)
-        except Exception as e:
-            session.logger.error(f"Failed to send lanes update: {e}")
-            remove_session(session)
-
 def trigger_lanes_position(loop):
     """Trigger an update for all sessions."""
     global sessions
@@ -60,14 +35,16 @@ def trigger_lanes_position(loop):
             session.logger.error(f"Failed to send lanes position: {e}")
             remove_session(session)
 
-def trigger_accidents_update(loop):
-    """Trigger an update for accidents for all sessions."""
+def trigger_lights_state(loop, lights):
+    """Sends changed traffic light states to the sessions whose frame contains one of them."""
     global sessions
-    logger.debug("Triggering accidents update for all sessions.")
+    logger.debug(f"Triggering {len(lights)} traffic light states for all sessions.")
     sess = sessions.copy()  # Create a copy to avoid modifying the set during iteration
+    # Sessions with the same frame share the encoded states
+    frames = {}
     for session in sess:
         try:
-            session.trigger_accidents_update(loop)
+            session.trigger_lights_state(loop, lights, frames)
         except Exception as e:
-            session.logger.error(f"Failed to send accidents update: {e}")
-            remove_session(session)
\ No newline at end of file
+            session.logger.error(f"Failed to send traffic light states: {e}")
+            remove_session(session)
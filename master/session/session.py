@@ -1,8 +1,10 @@
-import json, websockets, logging, asyncio
-from master.lane import getLanes, getLanesIn
-from master.traffic_light import getTrafficLight, getTrafficLightIn
+import json, websockets, logging, asyncio, time
+from master.accident import getAccidentsIn
 from master.session.registry import remove_session
-from master.vehicle import getVehiclesIn, getVehicles
+from master.session.delta import VehicleDeltaEncoder
+from master.session.codec import encode_message, BinaryEncoder
+from master.session.outbox import Outbox
+from master.metrics import metrics
 
 class Session:
     def __init__(self, websocket):
@@ -11,15 +13,59 @@ class Session:
         self.minPos = [None, None]
         self.maxPos = [None, None]
         self.focused = False
+        self.vehicleEncoder = None
+        self.binaryEncoder = None
+        self.laneResync = True
+        self.accidentsSent = None
+        self.outbox = None
+        self.writer = None
+        self.closed = False
+        self.sendLatency = 0.0
+        self.sendTime = 0.0
+        self.sendCount = 0
 
     async def init(self):
+        from master.handler import handler
         await self.websocket.send(json.dumps({
             "type": "traffic_light/position",
-            "data": getTrafficLight()
+            "data": handler.lightRegistry.getLights()
         }))
         self.logger.debug("WebSocket: Initial lanes sent to client.")
+        self.outbox = Outbox(asyncio.get_running_loop())
+        self.writer = asyncio.create_task(self.write_loop())
         self.logger.info("WebSocket: Client Connected.")
 
+    def close(self):
+        self.closed = True
+        if self.writer is not None:
+            self.writer.cancel()
+
+    async def write_loop(self):
+        """Single writer of the session, drains the outbox in order."""
+        while not self.closed:
+            message_type, frame = await self.outbox.get()
+            if callable(frame):
+                try:
+                    frame = frame()
+                except Exception as e:
+                    self.logger.error(f"WebSocket: Failed to encode {message_type} frame: {e}")
+                    continue
+            start = time.perf_counter()
+            if await self.send_encoded(frame):
+                latency = time.perf_counter() - start
+                self.sendLatency = latency
+                self.sendTime += latency
+                self.sendCount += 1
+                metrics.observe("claxon_session_send_seconds", latency)
+                # JSON frames are ASCII (json.dumps escapes the rest), so their length is their size
+                metrics.inc("claxon_sent_bytes_total", len(frame), type=message_type)
+
+    def queue(self, message_type, frame):
+        """Queues an encoded frame (or a callable encoding it) for the writer task, from any thread."""
+        if self.outbox is None or self.closed:
+            return False
+        return self.outbox.put(message_type, frame)
+
     async def tick(self):
         try:
             message = await asyncio.wait_for(self.websocket.recv(), timeout=60.0)  # Timeout après 60 secondes
@@ -46,21 +92,41 @@ class Session:
         if data["type"] == "session/frame_update":
             if "minX" in data["data"] and "minY" in data["data"] and "maxX" in data["data"] and "maxY" in data["data"]:
                 self.set_frame(data["data"]["minX"], data["data"]["minY"], data["data"]["maxX"], data["data"]["maxY"])
-                await self.websocket.send(json.dumps({
-                    "type": "lanes/position",
-                    "data": getLanesIn(data["data"]["minX"], data["data"]["minY"], data["data"]["maxX"], data["data"]["maxY"])
-                }))
+                self.laneResync = True
+                from master.handler import handler
+                self.queue("lanes/position", encode_message(
+                    "lanes/position",
+                    handler.laneCache.getLanesInEncoded(data["data"]["minX"], data["data"]["minY"], data["data"]["maxX"], data["data"]["maxY"]),
+                    dump_json=True
+                ))
             else:
                 self.logger.error("WebSocket: Frame update message missing required fields.")
         elif data["type"] == "session/focus":
-            self.focused = data["data"].get("focused", False)
+            focused = data["data"].get("focused", False)
+            if focused and not self.focused:
+                # Lane changesets were skipped while unfocused
+                self.laneResync = True
+            self.focused = focused
             self.logger.debug(f"WebSocket: Focus set to {self.focused}.")
+        elif data["type"] == "session/options":
+            if "vehicle_delta" in data["data"]:
+                self.vehicleEncoder = VehicleDeltaEncoder() if data["data"]["vehicle_delta"] else None
+                self.logger.debug(f"WebSocket: Vehicle delta stream set to {self.vehicleEncoder is not None}.")
+            if "encoding" in data["data"]:
+                # Binary frames carry full vehicle lists and take precedence over the delta stream
+                self.binaryEncoder = BinaryEncoder() if data["data"]["encoding"] == "binary" else None
+                self.logger.debug(f"WebSocket: Encoding set to {'binary' if self.binaryEncoder else 'json'}.")
+        elif data["type"] == "session/resync":
+            self.laneResync = True
+            if self.vehicleEncoder is not None:
+                self.vehicleEncoder.request_keyframe()
+            if self.binaryEncoder is not None:
+                self.binaryEncoder.request_reset()
         elif data["type"] == "session/update_vehicles":
             loop = asyncio.get_event_loop()
             self.trigger_vehicle_update(loop)
         elif data["type"] == "session/update_lights":
-            loop = asyncio.get_event_loop()
-            self.trigger_lights_update(loop)
+            self.trigger_lights_update()
         elif data["type"] == "session/update_accidents":
             loop = asyncio.get_event_loop()
             self.trigger_accidents_update(loop)
@@ -76,26 +142,9 @@ class Session:
             from master.handler import handler
             handler.send_traffic_light_state_command(light_id, new_state)
 
-    async def send(self, message_type, data, dump_json=False):
+    async def send_encoded(self, json_message):
+        """Writes an already serialized message, possibly shared with other sessions."""
         try:
-            if dump_json:
-                try:
-                    data = json.loads(data)
-                except json.JSONDecodeError as e:
-                    self.logger.error(f"WebSocket: Failed to parse JSON for dump_json=True: {e}")
-                    return False
-                    
-            message = {
-                "type": message_type,
-                "data": data
-            }
-            
-            try:
-                json_message = json.dumps(message)
-            except (TypeError, ValueError) as e:
-                self.logger.error(f"WebSocket: Failed to serialize message to JSON: {e}")
-                return False
-                
             try:
                 await asyncio.wait_for(
                     self.websocket.send(json_message), 
@@ -109,6 +158,7 @@ class Session:
         except websockets.exceptions.ConnectionClosed:
             self.logger.warning("WebSocket: Connection closed while trying to send message.")
             remove_session(self)
+            self.closed = True
             return False
         except Exception as e:
             self.logger.error(f"WebSocket: Error sending message: {e}")
@@ -119,42 +169,78 @@ class Session:
         self.maxPos = [maxX, maxY]
         self.logger.debug(f"WebSocket: Frame set to {self.minPos} - {self.maxPos}")
 
-    def trigger_vehicle_update(self, loop):
-        """Trigger an update for the vehicles in this session."""
+    def has_frame(self):
+        return self.minPos[0] is not None and self.maxPos[0] is not None
+
+    def frame_key(self):
+        """Identifies the viewport, sessions with the same key share their encoded frames."""
+        return (self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+
+    def get_vehicles(self, source):
+        if self.has_frame():
+            return source.getVehiclesIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+        return source.getVehicles()
+
+    def trigger_vehicle_update(self, loop, snapshot=None):
+        """Trigger an update for the vehicles in this session.
+
+        Vehicles are read from the step snapshot when given, otherwise from the handler's vehicle cache.
+        """
         if not self.focused:
             self.logger.info("WebSocket: Session not focused, skipping vehicle update.")
             return
         self.logger.info("WebSocket: Triggering vehicle update.")
         try:
-            vehicles = []
-            if self.minPos[0] is not None and self.maxPos[0] is not None:
-                vehicles = getVehiclesIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+            if snapshot is None:
+                from master.handler import handler
+                source = handler.vehicleCache
             else:
-                vehicles = getVehicles()
-            asyncio.run_coroutine_threadsafe(
-                self.send("vehicle", vehicles, False),
-                loop
-            )
+                source = snapshot
+            # Delta and binary frames depend on what the client already has, they are encoded by the writer
+            if self.binaryEncoder is not None:
+                vehicles, encoder = self.get_vehicles(source), self.binaryEncoder
+                self.queue("vehicle", lambda: encoder.encode_vehicles(vehicles))
+            elif self.vehicleEncoder is not None:
+                vehicles, encoder = self.get_vehicles(source), self.vehicleEncoder
+                self.queue("vehicle/delta", lambda: encode_message("vehicle/delta", encoder.encode(vehicles)))
+            elif snapshot is not None:
+                self.queue("vehicle", snapshot.encode_shared("vehicle", self.frame_key(), lambda: self.get_vehicles(snapshot)))
+            else:
+                self.queue("vehicle", encode_message("vehicle", self.get_vehicles(source)))
         except Exception as e:
             self.logger.error(f"WebSocket: Failed to send vehicles update: {e}")
             remove_session(self)
         
-    def trigger_lane_update(self, loop):
-        """Trigger an update for the lanes in this session."""
+    def trigger_lane_update(self, loop, snapshot=None):
+        """Trigger an update for the lanes in this session.
+
+        With a step snapshot only the lanes changed during the step are sent, unless the session needs a full resync.
+        """
         if not self.focused:
             # self.logger.warning("WebSocket: Session not focused, skipping lane update.")
             return
         try:
-            dataToSend = []
-            for lane in getLanesIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1]):
-                dataToSend.append({
-                    "id": lane["id"],
-                    "state": lane["jam"]
-                })
-            asyncio.run_coroutine_threadsafe(
-                self.send("lane/state", dataToSend, False),
-                loop
-            )
+            from master.handler import handler
+            resync = snapshot is None or self.laneResync
+            if not resync:
+                dataToSend = snapshot.getLaneStatesChangedIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+                if not dataToSend:
+                    return
+            else:
+                dataToSend = []
+                if self.has_frame():
+                    dataToSend = handler.laneCache.getLaneStatesIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+                    self.laneResync = False
+            if self.binaryEncoder is not None:
+                encoder = self.binaryEncoder
+                frame = lambda: encoder.encode_lane_states(dataToSend)
+            elif snapshot is not None:
+                frame = snapshot.encode_shared("lane/state", (self.frame_key(), resync), lambda: dataToSend)
+            else:
+                frame = encode_message("lane/state", dataToSend)
+            if self.queue("lane/state", frame):
+                # The replaced frame held changes the client never got
+                self.laneResync = True
         except Exception as e:
             self.logger.error(f"WebSocket: Failed to send lanes update: {e}")
             remove_session(self)
@@ -162,81 +248,87 @@ class Session:
     def trigger_lane_position(self, loop):
         """Trigger an update for the lanes position in this session."""
         try:
-            asyncio.run_coroutine_threadsafe(
-                self.send("lane/position", getLanesIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1]), False),
-                loop
-            )
+            from master.handler import handler
+            self.queue("lane/position", encode_message(
+                "lane/position",
+                handler.laneCache.getLanesInEncoded(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1]),
+                dump_json=True
+            ))
         except Exception as e:
             self.logger.error(f"WebSocket: Failed to send lanes position: {e}")
             remove_session(self)
 
-    def trigger_lights_update(self, loop):
-        """Trigger an update for the lights in this session."""
+    def trigger_lights_update(self):
+        """Queues the states of every light of the frame, on the client's request."""
         if not self.focused:
             self.logger.debug("WebSocket: Session not focused, skipping lights update.")
             return
         try:
-            lights = []
-            if self.minPos[0] is not None and self.maxPos[0] is not None:
-                lights = getTrafficLightIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+            from master.handler import handler
+            if self.has_frame():
+                lights = handler.lightRegistry.getLightsIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
             else:
-                lights = getTrafficLight()
-            asyncio.run_coroutine_threadsafe(
-                self.send("traffic_light/state", lights, False),
-                loop
-            )
+                lights = handler.lightRegistry.getLights()
+            self.queue("traffic_light/state", encode_message("traffic_light/state", lights))
         except Exception as e:
-            self.logger.error(f"WebSocket: Failed to send vehicles update: {e}")
+            self.logger.error(f"WebSocket: Failed to send lights update: {e}")
+            remove_session(self)
+
+    def trigger_lights_state(self, loop, lights, frames):
+        """Queues the changed lights lying inside the frame, every changed light without a frame.
+
+        frames holds the encoded message per frame_key, shared by the sessions of a state message.
+        """
+        if not self.focused:
+            return
+        try:
+            key = self.frame_key()
+            frame = frames.get(key)
+            if frame is None:
+                if self.has_frame():
+                    xmin, xmax = min(self.minPos[0], self.maxPos[0]), max(self.minPos[0], self.maxPos[0])
+                    ymin, ymax = min(self.minPos[1], self.maxPos[1]), max(self.minPos[1], self.maxPos[1])
+                    lights = [light for light in lights if xmin <= light['stop_lon'] <= xmax and ymin <= light['stop_lat'] <= ymax]
+                # An empty frame is cached too, so the filter runs once per key
+                frame = encode_message("traffic_light/state", lights) if lights else ""
+                frames[key] = frame
+            if frame and self.queue("traffic_light/state", frame):
+                # The replaced frame held changes the client never got, send the frame's full states
+                self.trigger_lights_update()
+        except Exception as e:
+            self.logger.error(f"WebSocket: Failed to send traffic light states: {e}")
             remove_session(self)
 
-    def trigger_accidents_update(self, loop):
+    def trigger_accidents_update(self, loop, snapshot=None):
         """Trigger an update for accidents in this session."""
         if not self.focused:
             self.logger.debug("WebSocket: Session not focused, skipping accidents update.")
             return
+        if snapshot is None:
+            asyncio.run_coroutine_threadsafe(self.update_accidents(), loop)
+            return
         try:
-            # Récupérer les accidents de la base de données
-            from master.database import connect_to_database
-            db = connect_to_database()
-            with db.cursor() as cursor:
-                cursor.execute(
-                    """
-                    SELECT vehicle_id as id,
-                           ST_X(geom) as longitude,
-                           ST_Y(geom) as latitude,
-                           type,
-                           start_time, zone, duration
-                    FROM accidents
-                    """,
-                )
-
-                accidents = []
-                for row in cursor.fetchall():
-                    # Déterminer si nous avons une colonne duration dans les résultats
-                    if len(row) >= 7:  # Avec duration
-                        accident_data = {
-                            "id": row[0],
-                            "position": [row[2], row[1]],  # [latitude, longitude]
-                            "type": row[3],
-                            "start_time": row[4],
-                            "zone": row[5],
-                            "duration": row[6]
-                        }
-                    else:  # Sans duration
-                        accident_data = {
-                            "id": row[0],
-                            "position": [row[2], row[1]],  # [latitude, longitude]
-                            "type": row[3],
-                            "start_time": row[4],
-                            "zone": row[5],
-                            "duration": 10  # Valeur par défaut
-                        }
-                    accidents.append(accident_data)
+            # The frame's accidents are only sent again when the set or the frame changed
+            sent = (snapshot.accidentsVersion, self.frame_key())
+            if snapshot.accidentsVersion is not None and sent == self.accidentsSent:
+                return
+            if self.has_frame():
+                build = lambda: snapshot.getAccidentsIn(self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+            else:
+                build = snapshot.getAccidents
+            self.queue("accident/position", snapshot.encode_shared("accident/position", self.frame_key(), build))
+            self.accidentsSent = sent
+        except Exception as e:
+            self.logger.error(f"WebSocket: Failed to send accidents update: {e}")
+            remove_session(self)
 
-            asyncio.run_coroutine_threadsafe(
-                self.send("accident/position", accidents, False),
-                loop
-            )
+    async def update_accidents(self):
+        try:
+            from master.handler import handler
+            accidents = handler.getAccidents()
+            if self.has_frame():
+                accidents = getAccidentsIn(accidents, self.minPos[0], self.minPos[1], self.maxPos[0], self.maxPos[1])
+            self.queue("accident/position", encode_message("accident/position", accidents))
         except Exception as e:
             self.logger.error(f"WebSocket: Failed to send accidents update: {e}")
             remove_session(self)
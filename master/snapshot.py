@@ -0,0 +1,57 @@
+import logging
+from master.session.codec import encode_message
+from master.accident import getAccidentsIn
+
+logger = logging.getLogger(__name__)
+
+class StepSnapshot:
+    """Vehicles, lane jams and accidents gathered once for a traci step.
+
+    Every session filters its viewport from the same snapshot in memory, so a
+    step costs one read per kind of data whatever the number of sessions.
+    """
+
+    def __init__(self, vehicleCache, laneCache, laneChanges, accidents, accidentsVersion=None):
+        self.vehicleCache = vehicleCache
+        self.laneCache = laneCache
+        self.laneChanges = laneChanges
+        self.accidents = accidents
+        self.accidentsVersion = accidentsVersion
+        self.frames = {}
+
+    def getVehicles(self):
+        return self.vehicleCache.getVehicles()
+
+    def getVehiclesIn(self, minX, minY, maxX, maxY):
+        """Same output as master.vehicle.getVehiclesIn, answered by the columnar vehicle store."""
+        return self.vehicleCache.getVehiclesIn(minX, minY, maxX, maxY)
+
+    def getLaneStatesChangedIn(self, minX, minY, maxX, maxY):
+        """Returns {id, state} for the lanes whose jam changed during this step and that intersect the frame."""
+        return self.laneCache.getLaneStatesChangedIn(self.laneChanges, minX, minY, maxX, maxY)
+
+    def getAccidents(self):
+        return self.accidents
+
+    def getAccidentsIn(self, minX, minY, maxX, maxY):
+        return getAccidentsIn(self.accidents, minX, minY, maxX, maxY)
+
+    def encode_shared(self, message_type, key, build):
+        """Encodes a message once per step for all the sessions asking with the same key."""
+        frame = self.frames.get((message_type, key))
+        if frame is None:
+            frame = encode_message(message_type, build())
+            self.frames[(message_type, key)] = frame
+        return frame
+
+def build_step_snapshot(handler):
+    """Gathers the current step from the handler's in-memory state.
+
+    The lane changeset recorded since the previous step is consumed here.
+    """
+    accidentStore = handler.accidentStore
+    # The version is read first, a change racing with the read is sent again on the next step
+    accidentsVersion = accidentStore.version
+    snapshot = StepSnapshot(handler.vehicleCache, handler.laneCache, handler.laneCache.popChanges(), accidentStore.getAccidents(), accidentsVersion)
+    logger.debug(f"Step snapshot built: {len(handler.vehicleCache)} vehicles, {len(snapshot.laneChanges)} lane changes, {len(snapshot.accidents)} accidents")
+    return snapshot
@@ -0,0 +1,217 @@
+import math, threading
+
+class GridIndex:
+    """Uniform grid over points, bucketed by (x, y) cell.
+
+    Items are kept in the bucket of their cell so a bounding box lookup only
+    visits the cells it overlaps instead of every point.
+    """
+
+    def __init__(self, cellSize):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.points = {}
+        self.lock = threading.Lock()
+
+    def _cell(self, x, y):
+        return (math.floor(x / self.cellSize), math.floor(y / self.cellSize))
+
+    def insert(self, key, x, y, item):
+        """Inserts or moves the point stored under key."""
+        cell = self._cell(x, y)
+        with self.lock:
+            previous = self.points.get(key)
+            if previous is not None and previous != cell:
+                self._discard(key, previous)
+            self.points[key] = cell
+            self.cells.setdefault(cell, {})[key] = (x, y, item)
+
+    def remove(self, key):
+        with self.lock:
+            cell = self.points.pop(key, None)
+            if cell is not None:
+                self._discard(key, cell)
+
+    def _discard(self, key, cell):
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            return
+        bucket.pop(key, None)
+        if not bucket:
+            del self.cells[cell]
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """Returns the items whose point lies inside the bounding box (bounds included)."""
+        cxmin, cymin = self._cell(xmin, ymin)
+        cxmax, cymax = self._cell(xmax, ymax)
+        found = []
+        with self.lock:
+            # Zoomed-out frames overlap more cells than exist, walk the occupied ones instead
+            if (cxmax - cxmin + 1) * (cymax - cymin + 1) > len(self.cells):
+                buckets = [
+                    bucket for (cx, cy), bucket in self.cells.items()
+                    if cxmin <= cx <= cxmax and cymin <= cy <= cymax
+                ]
+            else:
+                buckets = []
+                for cx in range(cxmin, cxmax + 1):
+                    for cy in range(cymin, cymax + 1):
+                        bucket = self.cells.get((cx, cy))
+                        if bucket is not None:
+                            buckets.append(bucket)
+            for bucket in buckets:
+                for x, y, item in bucket.values():
+                    if xmin <= x <= xmax and ymin <= y <= ymax:
+                        found.append(item)
+        return found
+
+def bbox_intersects(box, xmin, ymin, xmax, ymax):
+    return box[0] <= xmax and box[2] >= xmin and box[1] <= ymax and box[3] >= ymin
+
+def bbox_of(points):
+    """Returns (xmin, ymin, xmax, ymax) of a list of [x, y] points."""
+    xs = [pt[0] for pt in points]
+    ys = [pt[1] for pt in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+def segment_distance(point, start, end):
+    """Distance from a point to the segment [start, end]."""
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length = dx * dx + dy * dy
+    if length == 0:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+    t = max(0.0, min(1.0, ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length))
+    return math.hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a polyline, keeping its end points."""
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    pending = [(0, len(points) - 1)]
+    while pending:
+        first, last = pending.pop()
+        farthest, distance = None, tolerance
+        for index in range(first + 1, last):
+            d = segment_distance(points[index], points[first], points[last])
+            if d > distance:
+                farthest, distance = index, d
+        if farthest is not None:
+            keep[farthest] = True
+            pending.append((first, farthest))
+            pending.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+class PackedRTree:
+    """R-tree over bounding boxes, bulk loaded with Sort-Tile-Recursive packing.
+
+    Boxes inserted after the last build wait in a small overflow list that is
+    scanned linearly; the tree is repacked once enough entries are pending or
+    stale. Moving a key is an insert with its new box, the packed entry of the
+    old box is ignored by lookups until the next repack.
+    """
+
+    def __init__(self, nodeCapacity=16):
+        self.nodeCapacity = nodeCapacity
+        self.boxes = {}
+        self.root = None
+        self.pending = {}
+        self.stale = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def build(self, entries):
+        """Bulk loads the tree from (key, bbox) pairs, replacing its content."""
+        with self.lock:
+            self.boxes = dict(entries)
+            self._pack()
+
+    def insert(self, key, bbox):
+        with self.lock:
+            if self.boxes.get(key) is bbox:
+                return
+            if key in self.boxes and key not in self.pending:
+                self.stale += 1
+            self.boxes[key] = bbox
+            self.pending[key] = bbox
+            if len(self.pending) + self.stale > max(64, len(self.boxes) // 10):
+                self._pack()
+
+    def get(self, key):
+        return self.boxes.get(key)
+
+    def remove(self, key):
+        with self.lock:
+            if self.boxes.pop(key, None) is None:
+                return
+            if self.pending.pop(key, None) is None:
+                self.stale += 1
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """Returns the keys whose box intersects the bounding box."""
+        found = []
+        with self.lock:
+            boxes = self.boxes
+            stack = [self.root] if self.root is not None else []
+            while stack:
+                bxmin, bymin, bxmax, bymax, children, leaf = stack.pop()
+                if bxmin > xmax or bxmax < xmin or bymin > ymax or bymax < ymin:
+                    continue
+                if leaf:
+                    for key, box in children:
+                        if (box[0] <= xmax and box[2] >= xmin and box[1] <= ymax and box[3] >= ymin
+                                and boxes.get(key) is box):
+                            found.append(key)
+                else:
+                    stack.extend(children)
+            for key, box in self.pending.items():
+                if box[0] <= xmax and box[2] >= xmin and box[1] <= ymax and box[3] >= ymin:
+                    found.append(key)
+        return found
+
+    def _pack(self):
+        self.pending = {}
+        self.stale = 0
+        entries = list(self.boxes.items())
+        if not entries:
+            self.root = None
+            return
+        nodes = [
+            self._node(chunk, True)
+            for chunk in self._tile(entries, lambda entry: entry[1])
+        ]
+        while len(nodes) > 1:
+            nodes = [
+                self._node(chunk, False)
+                for chunk in self._tile(nodes, lambda node: node)
+            ]
+        self.root = nodes[0]
+
+    def _tile(self, items, boxOf):
+        """Groups items in runs of nodeCapacity, sliced by x then sorted by y (STR)."""
+        capacity = self.nodeCapacity
+        nodeCount = math.ceil(len(items) / capacity)
+        sliceSize = capacity * math.ceil(math.sqrt(nodeCount))
+        items = sorted(items, key=lambda item: boxOf(item)[0] + boxOf(item)[2])
+        for start in range(0, len(items), sliceSize):
+            tile = sorted(items[start:start + sliceSize], key=lambda item: boxOf(item)[1] + boxOf(item)[3])
+            for chunk in range(0, len(tile), capacity):
+                yield tile[chunk:chunk + capacity]
+
+    @staticmethod
+    def _node(children, leaf):
+        boxes = [child[1] for child in children] if leaf else children
+        return (
+            min(box[0] for box in boxes),
+            min(box[1] for box in boxes),
+            max(box[2] for box in boxes),
+            max(box[3] for box in boxes),
+            children,
+            leaf
+        )
@@ -1,4 +1,103 @@
 from master.database import connect_to_database
+from master.spatial import GridIndex
+from master.zone import normalize_zone
+import os, threading
+
+# Grid cell size in degrees used to index traffic light positions (~1 km by default)
+TRAFFIC_LIGHT_GRID_CELL_SIZE = float(os.environ.get("TRAFFIC_LIGHT_GRID_CELL_SIZE", 0.01))
+
+# Fields of a light record that belong to the topology, its state excluded
+TOPOLOGY_FIELDS = ("in_lane", "out_lane", "via_lane", "stop_lat", "stop_lon")
+
+class TrafficLightRegistry:
+    """Traffic lights of every zone, loaded once and kept current by the nodes' messages.
+
+    Records have the output format of getTrafficLightIn and are replaced, never
+    mutated, so lists handed to sessions stay consistent.
+    """
+    lights = {}
+    zones = {}
+    owners = {}
+    index = None
+
+    def __init__(self):
+        self.index = GridIndex(TRAFFIC_LIGHT_GRID_CELL_SIZE)
+        self.lock = threading.Lock()
+        self.lights = {}
+        self.zones = {}
+        self.owners = {}
+        for light in getTrafficLightRecords():
+            self._put(normalize_zone(light.pop("zone")), light)
+
+    def _put(self, zone, record):
+        owner = self.owners.get(record['id'])
+        if owner is not None and owner != zone:
+            # A light moving to another zone is no longer removed with its former zone
+            self.zones.get(owner, set()).discard(record['id'])
+        self.lights[record['id']] = record
+        self.owners[record['id']] = zone
+        self.zones.setdefault(zone, set()).add(record['id'])
+        self.index.insert(record['id'], record['stop_lon'], record['stop_lat'], record)
+
+    def setZone(self, zone, lights):
+        """Replaces the lights of a zone with the ones a node sent, keeping the known states.
+
+        Returns the records of the lights added or moved (position or lanes),
+        and the ids of the zone's lights that are gone.
+        """
+        zone = normalize_zone(zone)
+        changed = []
+        with self.lock:
+            previous = self.zones.pop(zone, set())
+            for light in lights:
+                known = self.lights.get(light['id'])
+                record = {
+                    "id": light['id'],
+                    "in_lane": light.get('in_lane'),
+                    "out_lane": light.get('out_lane'),
+                    "via_lane": light.get('via_lane'),
+                    # Nodes send [y, x] positions
+                    "stop_lat": light['position'][0],
+                    "stop_lon": light['position'][1],
+                    "state": light.get('state', known['state'] if known else None)
+                }
+                if known is None or self.owners.get(light['id']) != zone or any(
+                    known[field] != record[field] for field in TOPOLOGY_FIELDS
+                ):
+                    changed.append(record)
+                self._put(zone, record)
+            removed = []
+            for light_id in previous - self.zones.get(zone, set()):
+                if self.owners.get(light_id) == zone:
+                    del self.lights[light_id]
+                    del self.owners[light_id]
+                    self.index.remove(light_id)
+                    removed.append(light_id)
+        return changed, removed
+
+    def applyStates(self, states):
+        """Sets the states of known lights, returns the records of the lights whose state changed."""
+        changed = []
+        with self.lock:
+            for light_id, state in states.items():
+                known = self.lights.get(light_id)
+                if known is None or known['state'] == state:
+                    continue
+                record = dict(known, state=state)
+                self.lights[light_id] = record
+                self.index.insert(light_id, record['stop_lon'], record['stop_lat'], record)
+                changed.append(record)
+        return changed
+
+    def getLights(self):
+        """Same output as getTrafficLightIn over the whole map, read from memory."""
+        with self.lock:
+            return list(self.lights.values())
+
+    def getLightsIn(self, minX, minY, maxX, maxY):
+        """Same output as getTrafficLightIn, read from memory."""
+        return self.index.query(min(minX, maxX), min(minY, maxY), max(minX, maxX), max(minY, maxY))
+
 
 def getTrafficLight():
     lightsFormatted = []
@@ -52,9 +151,32 @@ def getTrafficLightIn(minX, minY, maxX, maxY):
             })
     return lightsFormatted
 
+def getTrafficLightRecords():
+    """Every light in the output format of getTrafficLightIn, with its zone."""
+    db = connect_to_database()
+    with db.cursor() as cursor:
+        cursor.execute("""
+            SELECT id, in_lane, out_lane, via_lane,
+                   ST_Y(geom) AS lat, ST_X(geom) AS lon, state, zone
+            FROM traffic_lights;
+        """)
+        return [
+            {
+                "id": tl[0],
+                "in_lane": tl[1],
+                "out_lane": tl[2],
+                "via_lane": tl[3],
+                "stop_lat": tl[4],
+                "stop_lon": tl[5],
+                "state": tl[6],
+                "zone": tl[7]
+            }
+            for tl in cursor.fetchall()
+        ]
+
 def getTrafficLightIndexed():
     lights = getTrafficLight()
     lightsIndexed = {}
     for light in lights:
         lightsIndexed[light['id']] = light
-    return lightsIndexed
\ No newline at end of file
+    return lightsIndexed
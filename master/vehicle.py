@@ -1,17 +1,75 @@
 from master.database import connect_to_database
+from master.vehicle_store import ColumnarVehicleStore
 import json
 
+VEHICLE_FIELDS = ("id", "position", "type", "angle", "speed", "accident")
+
+def columns_of(vehicles):
+    """Splits (id, x, y, type, angle, speed, accident) tuples into columns, followed by their public dicts."""
+    if vehicles:
+        columns = tuple(zip(*vehicles))[:7]
+    else:
+        columns = ((),) * 7
+    records = [
+        {"id": v[0], "position": [v[1], v[2]], "type": v[3], "angle": v[4], "speed": v[5], "accident": v[6]}
+        for v in vehicles
+    ]
+    return columns + (records,)
+
 class VehicleCache:
-    vehicles = {}
+    """Vehicles partitioned by the zone reporting them, stored in columns.
+
+    Each zone is diffed and cleaned against its own vehicles only; a vehicle
+    reported by another zone changes owner instead of being removed. Change
+    detection and viewport filtering are vectorized over the columns.
+    """
+    store = None
+    stats = {}
 
     def __init__(self):
-        self.vehicles = getVehiclesIndexed()
+        self.store = ColumnarVehicleStore()
+        self.stats = {}
+        self.setCached(getVehiclesIndexed())
 
-    def getCached(self):
-        return self.vehicles
-    
     def setCached(self, vehicles):
-        self.vehicles = vehicles
+        self.store.load(
+            (vehicle.get('zone', 0), {field: vehicle.get(field) for field in VEHICLE_FIELDS})
+            for vehicle in vehicles.values()
+        )
+
+    def __len__(self):
+        return len(self.store)
+
+    def applyZone(self, zone, vehicles):
+        """Applies the vehicles reported by a zone, given as (id, x, y, type, angle, speed, accident) tuples.
+
+        Returns the tuples of the new or changed vehicles, and the ids of the zone's vehicles that are gone.
+        """
+        changed, removed = self.store.apply_zone(zone, *columns_of(vehicles))
+        return [vehicles[index] for index in changed], removed
+
+    def applyChanges(self, zone, changed, removed):
+        """Applies changes diffed by an ingest worker, same tuples as the output of applyZone."""
+        self.store.apply_changes(zone, *columns_of(changed), removed)
+
+    def setZoneStats(self, zone, upserted, removed, unchanged):
+        self.stats[zone] = {
+            "vehicles": self.store.count_zone(zone),
+            "upserted": upserted,
+            "removed": removed,
+            "unchanged": unchanged
+        }
+
+    def getZoneStats(self):
+        return dict(self.stats)
+
+    def getVehicles(self):
+        """Same output as getVehicles, read from memory."""
+        return self.store.all()
+
+    def getVehiclesIn(self, minX, minY, maxX, maxY):
+        """Same output as getVehiclesIn, read from memory."""
+        return self.store.query(min(minX, maxX), min(minY, maxY), max(minX, maxX), max(minY, maxY))
 
 def getVehicles():
     vehiclesFormatted = []
@@ -61,8 +119,19 @@ def getVehiclesIn(minX, minY, maxX, maxY):
     return vehiclesFormatted
 
 def getVehiclesIndexed():
-    lanes = getVehicles()
-    lanesIndexed = {}
-    for lane in lanes:
-        lanesIndexed[lane['id']] = lane
-    return lanesIndexed
\ No newline at end of file
+    """Returns the vehicles indexed by their ID, with the zone owning them."""
+    vehiclesIndexed = {}
+    db = connect_to_database()
+    with db.cursor() as cursor:
+        cursor.execute("SELECT ST_X(geom), ST_Y(geom), id, type, angle, speed, accident, zone FROM vehicles;")
+        for vehicle in cursor.fetchall():
+            vehiclesIndexed[vehicle[2]] = {
+                "id": vehicle[2],
+                "position": [vehicle[0], vehicle[1]],
+                "type": vehicle[3],
+                "angle": vehicle[4],
+                "speed": vehicle[5],
+                "accident": vehicle[6],
+                "zone": vehicle[7]
+            }
+    return vehiclesIndexed
@@ -0,0 +1,114 @@
+from .bulk import copy_rows
+from .persistence import Deletion
+from .zone import normalize_zone
+import os
+
+# "copy" streams vehicle rows through a staging table, "insert" sends one INSERT ... VALUES statement
+VEHICLE_INGEST_MODE = os.environ.get("VEHICLE_INGEST_MODE", "copy")
+
+class VehicleIngest:
+    """Vehicle position handling, shared by the handler and the zone ingest workers.
+
+    Expects self.vehicleCache, self.persistence (with a "vehicles" table
+    registered to flush_vehicles) and self.logger.
+    """
+
+    def handle_vehicle_position(self, loop, data):
+        zone = normalize_zone(data.get("zone", 0))
+        self.logger.info(f"Handling vehicle position for zone {zone}")
+
+        reported = []
+        for vehicle in data.get("data", []):
+            # Nodes send [y, x] positions
+            reported.append((
+                vehicle['id'],
+                vehicle['position'][1],
+                vehicle['position'][0],
+                vehicle.get('type'),
+                vehicle.get('angle'),
+                vehicle.get('speed'),
+                vehicle.get('accident', False)
+            ))
+
+        # Only this zone's vehicles are diffed and removed, other zones keep theirs
+        changed, vehicles_to_remove = self.vehicleCache.applyZone(zone, reported)
+        vehicles_to_upsert = [vehicle + (zone,) for vehicle in changed]
+
+        # Queue database operations, written in batches by the write-behind flusher
+        dirty = {row[0]: row for row in vehicles_to_upsert}
+        dirty.update((vehicle_id, Deletion(zone)) for vehicle_id in vehicles_to_remove)
+        self.persistence.mark_many("vehicles", dirty)
+
+        unchanged = len(reported) - len(vehicles_to_upsert)
+        self.vehicleCache.setZoneStats(zone, len(vehicles_to_upsert), len(vehicles_to_remove), unchanged)
+        self.logger.debug(f"Vehicle positions updated for zone {zone}: {len(vehicles_to_upsert)} upserted, {len(vehicles_to_remove)} removed, {unchanged} unchanged")
+        return zone, vehicles_to_upsert, vehicles_to_remove, unchanged
+
+    def flush_vehicles(self, cursor, rows):
+        vehicles_to_upsert = []
+        vehicles_to_remove = {}
+        for vehicle_id, row in rows.items():
+            if isinstance(row, Deletion):
+                vehicles_to_remove.setdefault(row.zone, []).append(vehicle_id)
+            else:
+                vehicles_to_upsert.append(row)
+        if VEHICLE_INGEST_MODE == "copy":
+            self.write_vehicles_copy(cursor, vehicles_to_upsert)
+        else:
+            self.write_vehicles_insert(cursor, vehicles_to_upsert)
+        for zone, vehicle_ids in vehicles_to_remove.items():
+            cursor.execute(
+                "DELETE FROM vehicles WHERE id = ANY(%s) AND zone = %s",
+                (vehicle_ids, zone)
+            )
+
+    def write_vehicles_insert(self, cursor, vehicles_to_upsert):
+        # Batch upsert
+        if vehicles_to_upsert:
+            args_str = ','.join(
+                cursor.mogrify("(%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326), %s, %s, %s, %s, %s)", x).decode('utf-8')
+                for x in vehicles_to_upsert
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO vehicles (id, geom, type, angle, speed, accident, zone)
+                VALUES {args_str}
+                ON CONFLICT (id) DO UPDATE SET
+                    geom = EXCLUDED.geom,
+                    type = EXCLUDED.type,
+                    angle = EXCLUDED.angle,
+                    speed = EXCLUDED.speed,
+                    accident = EXCLUDED.accident,
+                    zone = EXCLUDED.zone
+                """
+            )
+
+    def write_vehicles_copy(self, cursor, vehicles_to_upsert):
+        """Streams the changed rows into a staging table and merges them, inside the flush transaction."""
+        if not vehicles_to_upsert:
+            return
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS vehicles_staging (
+                id VARCHAR(50),
+                x FLOAT,
+                y FLOAT,
+                type VARCHAR(50),
+                angle FLOAT,
+                speed FLOAT,
+                accident BOOLEAN,
+                zone INTEGER
+            ) ON COMMIT DELETE ROWS
+        """)
+        copy_rows(cursor, "vehicles_staging", ("id", "x", "y", "type", "angle", "speed", "accident", "zone"), vehicles_to_upsert)
+        cursor.execute("""
+            INSERT INTO vehicles (id, geom, type, angle, speed, accident, zone)
+            SELECT DISTINCT ON (id) id, ST_SetSRID(ST_MakePoint(x, y), 4326), type, angle, speed, accident, zone
+            FROM vehicles_staging
+            ON CONFLICT (id) DO UPDATE SET
+                geom = EXCLUDED.geom,
+                type = EXCLUDED.type,
+                angle = EXCLUDED.angle,
+                speed = EXCLUDED.speed,
+                accident = EXCLUDED.accident,
+                zone = EXCLUDED.zone
+        """)
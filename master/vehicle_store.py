@@ -0,0 +1,189 @@
+import threading
+import numpy as np
+
+def differs(current, incoming):
+    """Elementwise !=, where two NaN (missing values) compare equal."""
+    return (current != incoming) & ~(np.isnan(current) & np.isnan(incoming))
+
+class ColumnarVehicleStore:
+    """Vehicle state held in NumPy columns, one row per vehicle.
+
+    Rows are found through an id -> row dict and recycled through a free-list.
+    Each row also keeps its vehicle's public dict, rebuilt only when the
+    vehicle changes, so lookups hand out the same objects step after step.
+    """
+
+    def __init__(self, capacity=1024):
+        self.rows = {}
+        self.free = []
+        self.size = 0
+        self.zoneCodes = {}
+        self.lock = threading.Lock()
+        self._allocate_columns(capacity)
+
+    def _allocate_columns(self, capacity):
+        self.x = np.full(capacity, np.nan)
+        self.y = np.full(capacity, np.nan)
+        self.angle = np.full(capacity, np.nan)
+        self.speed = np.full(capacity, np.nan)
+        self.accident = np.zeros(capacity, dtype=bool)
+        self.zone = np.full(capacity, -1, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.ids = np.empty(capacity, dtype=object)
+        self.types = np.empty(capacity, dtype=object)
+        self.records = [None] * capacity
+
+    def _grow(self):
+        capacity = len(self.alive)
+        columns = (self.x, self.y, self.angle, self.speed, self.accident, self.zone, self.alive, self.ids, self.types)
+        records = self.records
+        self._allocate_columns(capacity * 2)
+        for old, new in zip(columns, (self.x, self.y, self.angle, self.speed, self.accident, self.zone, self.alive, self.ids, self.types)):
+            new[:capacity] = old
+        self.records[:capacity] = records
+
+    def _allocate(self, vehicle_id):
+        row = self.rows.get(vehicle_id)
+        if row is not None:
+            return row
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == len(self.alive):
+                self._grow()
+            row = self.size
+            self.size += 1
+        self.rows[vehicle_id] = row
+        self.ids[row] = vehicle_id
+        self.alive[row] = True
+        return row
+
+    def _release(self, row):
+        del self.rows[self.ids[row]]
+        self.alive[row] = False
+        self.zone[row] = -1
+        self.ids[row] = None
+        self.types[row] = None
+        self.records[row] = None
+        self.free.append(row)
+
+    def zone_code(self, zone):
+        return self.zoneCodes.setdefault(zone, len(self.zoneCodes))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _columns(self, ids, xs, ys, types, angles, speeds, accidents):
+        vehicleTypes = np.empty(len(ids), dtype=object)
+        vehicleTypes[:] = types
+        return (
+            np.array(xs, dtype=float),
+            np.array(ys, dtype=float),
+            np.array(angles, dtype=float),
+            np.array(speeds, dtype=float),
+            np.array(accidents, dtype=bool),
+            vehicleTypes,
+        )
+
+    def _write(self, rows, indexes, code, columns, records):
+        """Writes the incoming vehicles at indexes into their rows."""
+        x, y, angle, speed, accident, vehicleTypes = columns
+        self.x[rows] = x[indexes]
+        self.y[rows] = y[indexes]
+        self.angle[rows] = angle[indexes]
+        self.speed[rows] = speed[indexes]
+        self.accident[rows] = accident[indexes]
+        self.zone[rows] = code
+        self.types[rows] = vehicleTypes[indexes]
+        for index, row in zip(indexes.tolist(), rows.tolist()):
+            self.records[row] = records[index]
+
+    def apply_zone(self, zone, ids, xs, ys, types, angles, speeds, accidents, records):
+        """Applies the full report of one zone.
+
+        Returns the indexes of the incoming vehicles that are new or changed,
+        and the ids of the zone's vehicles missing from the report. records
+        holds the public dict of each incoming vehicle.
+        """
+        count = len(ids)
+        columns = self._columns(ids, xs, ys, types, angles, speeds, accidents)
+        x, y, angle, speed, accident, vehicleTypes = columns
+
+        with self.lock:
+            code = self.zone_code(zone)
+            rows = np.fromiter((self.rows.get(vehicle_id, -1) for vehicle_id in ids), dtype=np.int64, count=count)
+            new = rows < 0
+            for index in np.flatnonzero(new):
+                rows[index] = self._allocate(ids[index])
+
+            changed = (
+                new
+                | differs(self.x[rows], x)
+                | differs(self.y[rows], y)
+                | differs(self.angle[rows], angle)
+                | differs(self.speed[rows], speed)
+                | (self.accident[rows] != accident)
+                | (self.zone[rows] != code)
+                | (self.types[rows] != vehicleTypes)
+            )
+            changedIndexes = np.flatnonzero(changed)
+            self._write(rows[changedIndexes], changedIndexes, code, columns, records)
+
+            # Rows of this zone that the report did not mention
+            seen = np.zeros(len(self.alive), dtype=bool)
+            seen[rows] = True
+            removedRows = np.flatnonzero(self.alive & (self.zone == code) & ~seen)
+            removed = [self.ids[row] for row in removedRows.tolist()]
+            for row in removedRows.tolist():
+                self._release(row)
+
+        return changedIndexes.tolist(), removed
+
+    def apply_changes(self, zone, ids, xs, ys, types, angles, speeds, accidents, records, removed):
+        """Applies changes of one zone that were already diffed, by an ingest worker.
+
+        Removed vehicles are only released if they still belong to the zone.
+        """
+        columns = self._columns(ids, xs, ys, types, angles, speeds, accidents)
+        with self.lock:
+            code = self.zone_code(zone)
+            rows = np.array([self._allocate(vehicle_id) for vehicle_id in ids], dtype=np.int64)
+            self._write(rows, np.arange(len(ids)), code, columns, records)
+            for vehicle_id in removed:
+                row = self.rows.get(vehicle_id)
+                if row is not None and self.zone[row] == code:
+                    self._release(row)
+
+    def load(self, vehicles):
+        """Replaces the content of the store with (zone, record) pairs."""
+        with self.lock:
+            self.rows = {}
+            self.free = []
+            self.size = 0
+            self._allocate_columns(max(1024, len(self.alive)))
+            for zone, record in vehicles:
+                row = self._allocate(record['id'])
+                self.x[row], self.y[row] = record['position'][0], record['position'][1]
+                self.angle[row] = np.nan if record.get('angle') is None else record['angle']
+                self.speed[row] = np.nan if record.get('speed') is None else record['speed']
+                self.accident[row] = bool(record.get('accident'))
+                self.zone[row] = self.zone_code(zone)
+                self.types[row] = record.get('type')
+                self.records[row] = record
+
+    def count_zone(self, zone):
+        with self.lock:
+            return int(np.count_nonzero(self.alive & (self.zone == self.zone_code(zone))))
+
+    def all(self):
+        with self.lock:
+            return [self.records[row] for row in np.flatnonzero(self.alive).tolist()]
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """Returns the public dict of the vehicles inside the bounding box (bounds included)."""
+        with self.lock:
+            size = self.size
+            x = self.x[:size]
+            y = self.y[:size]
+            mask = self.alive[:size] & (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+            return [self.records[row] for row in np.flatnonzero(mask).tolist()]
@@ -4,13 +4,42 @@ import asyncio
 import websockets
 
 from .session.session import Session
+from .session.codec import encode_message
 from .session.registry import add_session, remove_session, get_sessions
+from .loop_monitor import monitor_event_loop, loop_lag
+from .metrics import metrics, start_metrics_server
 
 logger = logging.getLogger(__name__)
 
+metrics.gauge("claxon_sessions", lambda: len(get_sessions()))
+metrics.gauge("claxon_session_queue_depth", lambda: [
+    ({"session": hex(id(session))}, session.outbox.depth())
+    for session in list(get_sessions()) if session.outbox is not None
+])
+metrics.gauge("claxon_session_queue_lag_seconds", lambda: [
+    ({"session": hex(id(session))}, session.outbox.lag)
+    for session in list(get_sessions()) if session.outbox is not None
+])
+metrics.gauge("claxon_session_send_last_seconds", lambda: [
+    ({"session": hex(id(session))}, session.sendLatency)
+    for session in list(get_sessions())
+])
+metrics.gauge("claxon_session_send_avg_seconds", lambda: [
+    ({"session": hex(id(session))}, session.sendTime / session.sendCount)
+    for session in list(get_sessions()) if session.sendCount
+])
+metrics.gauge("claxon_event_loop_lag_seconds", lambda: loop_lag.last)
+metrics.gauge("claxon_event_loop_lag_max_seconds", lambda: loop_lag.max)
+
 async def broadcast_websocket_message(message_type, data, dump_json = False):
-    for session in get_sessions():
-        await session.send(message_type, data, dump_json)
+    """Encodes the message once and queues it for every session's writer."""
+    try:
+        message = encode_message(message_type, data, dump_json)
+    except (TypeError, ValueError) as e:
+        logger.error(f"WebSocket: Failed to serialize broadcast message to JSON: {e}")
+        return
+    for session in list(get_sessions()):
+        session.queue(message_type, message)
 
 async def handle_websocket_connection(websocket):
     logger.info("WebSocket: Client Connected.")
@@ -43,11 +72,18 @@ async def handle_websocket_connection(websocket):
             logger.info("WebSocket: Client Disconnected.")
             try:
                 remove_session(session)
+                session.close()
             except Exception as e:
                 logger.error(f"WebSocket: Error removing session: {e}")
 
 
 async def start_websocket_server():
     """Démarrage du serveur WebSocket."""
-    async with websockets.serve(handle_websocket_connection, "0.0.0.0", 7900):
-        await asyncio.Future()  # run forever
\ No newline at end of file
+    monitor = asyncio.create_task(monitor_event_loop())
+    metrics_server = await start_metrics_server()
+    try:
+        async with websockets.serve(handle_websocket_connection, "0.0.0.0", 7900):
+            await asyncio.Future()  # run forever
+    finally:
+        monitor.cancel()
+        metrics_server.close()
\ No newline at end of file
@@ -0,0 +1,18 @@
+import re
+
+def normalize_zone(zone):
+    """Nodes send their zone as a string, the database stores an integer."""
+    try:
+        return int(zone)
+    except (TypeError, ValueError):
+        return zone
+
+# Nodes publish {"data": ..., "zone": ...}, so the zone sits at the end of the payload
+PAYLOAD_ZONE = re.compile(rb'"zone"\s*:\s*"?([^",}\s]*)"?\s*}\s*$')
+
+def zone_of_payload(payload):
+    """Reads the zone of a raw node payload without decoding the JSON, None unless it is the last member."""
+    match = PAYLOAD_ZONE.search(payload[-64:])
+    if match is None:
+        return None
+    return normalize_zone(match.group(1).decode('utf-8', 'replace'))